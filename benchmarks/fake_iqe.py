@@ -0,0 +1,95 @@
+# File Desc: A synthetic stand-in of iQE that makes up unpaid and deleted bills instead of
+#   querying the WSIS database, so the sync stages can be benchmarked without SQL Server
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+from collections import namedtuple
+from datetime import date, timedelta
+
+
+Bill = namedtuple('Bill', ['billID', 'name', 'customerCode', 'contractNo', 'phoneNo', 'email', 'amount'])
+# a deleted bill; the generated customers have no other unpaid bill left
+Tombstone = namedtuple('Tombstone', Bill._fields + ('liveBillID',))
+
+
+class FakeIQE:
+    """
+    Answers the iQE calls made by DerashClient and WSISClient with generated data. Customer n
+    has bill id n; every tenth customer also has a second bill, as STRING_AGG would return.
+    """
+    def __init__(self, bills, deleted=0, days=1, period="Tikimt 2019"):
+        """
+        :param bills: number of customers with unpaid bills
+        :param deleted: number of those customers returned as deleted by iterDeletedBills
+        :param days: number of days back getMinUnpaidDate is
+        :param period: the current bill period
+        """
+        self.bills = bills
+        self.deleted = deleted
+        self.days = days
+        self.period = period
+        self.revision = 0           # bumped by changeAmounts, changes every bill amount
+        self.connected = True
+        self.watermarks = 0
+        self.pendingFullScan = True # every pass reads all the bills
+
+
+    def bill(self, n):
+        billID = f"{n},{n + 10000000}" if n % 10 == 0 else str(n)
+        return Bill(billID, f"Customer {n}", f"C{n:08d}", f"K{n:08d}", f"09{n:08d}",
+                    f"customer{n}@example.com", 100 + n % 50 + self.revision)
+
+
+    def changeAmounts(self):
+        """
+        Make's every bill differ from what was uploaded so the next upload updates them all
+        """
+        self.revision += 1
+
+
+    def getCurrentPeriod(self):
+        return self.period
+
+
+    def getDueDate(self, pid=None):
+        return date.today() + timedelta(days=30)
+
+
+    def iterUnpaidBills(self, incremental=None):
+        for n in range(1, self.bills + 1):
+            yield self.bill(n)
+
+
+    def getUnpaidBills(self, incremental=None):
+        return list(self.iterUnpaidBills(incremental))
+
+
+    def commitWatermark(self):
+        self.watermarks += 1
+
+
+    def iterDeletedBills(self, mark=0):
+        # a tombstone carries the id of the one bill deleted, in id order
+        for n in range(max(0, int(mark)) + 1, self.deleted + 1):
+            yield Tombstone(*self.bill(n)._replace(billID=str(n)), liveBillID=None)
+
+
+    def getDeletedBills(self, mark=0):
+        return list(self.iterDeletedBills(mark))
+
+
+    def getMinUnpaidDate(self):
+        return date.today() - timedelta(days=self.days - 1)
+
+
+    def getSettledBillsBatch(self, billIDs):
+        settled = {}
+        for billID in billIDs:
+            if str(billID).isdigit():
+                settled[int(billID)] = [int(billID)]
+        return settled
+
+
+    def disconnect(self):
+        self.connected = False
@@ -0,0 +1,308 @@
+# File Desc: Local stand-ins of INSA Derash and WSIS HTTP APIs used to benchmark Bronze without
+#   touching production. Both take a latency, an error rate and a rate limit applied to every request.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import http.server
+import json
+import multiprocessing
+import random
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from urllib.parse import urlparse, parse_qs
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Keep-alive request handler, the behaviour comes from the server object it's attached to
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True      # headers and body go out as separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def acceptsGzip(self):
+        return 'gzip' in self.headers.get('Accept-Encoding', '')
+
+
+    def reply(self, status, body=b'', contentType='application/json', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if len(body) >= 1024 and self.acceptsGzip():       # not worth it for small bodies
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else None
+
+
+    def handle_one_request(self):
+        # clients dropping a keep-alive connection is normal, not worth a traceback
+        try:
+            super().handle_one_request()
+        except ConnectionError:
+            self.close_connection = True
+
+
+    def route(self, method):
+        """
+        Applies the server's latency, error rate and rate limit, then hands the request to the server
+        """
+        body = self.readBody() if method in ('POST', 'PUT') else None
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+        if not self.server.admit():
+            return self.reply(429, b'{"error":"rate limited"}', headers={'Retry-After': '1'})
+        if self.server.errorRate > 0 and random.random() < self.server.errorRate:
+            return self.reply(503, b'{"error":"injected"}')
+
+        url = urlparse(self.path)
+        self.server.route(self, method, url.path, parse_qs(url.query), body)
+
+
+    def do_GET(self):
+        self.route('GET')
+
+
+    def do_POST(self):
+        self.route('POST')
+
+
+    def do_PUT(self):
+        self.route('PUT')
+
+
+class MockServer(http.server.ThreadingHTTPServer):
+    """
+    Base of the mock servers, serves on a random local port from a daemon thread
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, errorRate=0.0, rateLimit=0):
+        """
+        :param latency: seconds added to every request
+        :param errorRate: fraction of requests answered with 503
+        :param rateLimit: requests per second above which requests are answered with 429, 0 for none
+        """
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.rateLimit = rateLimit
+        self.window = (0, 0)            # (second, requests admitted in it) of the rate limit
+        self.limited = 0                # requests answered with 429
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+    def admit(self):
+        """
+        :return: False if the request is over the rate limit of the current second
+        """
+        if self.rateLimit <= 0:
+            return True
+        with self.lock:
+            second = int(time.monotonic())
+            count = self.window[1] + 1 if self.window[0] == second else 1
+            self.window = (second, count)
+            if count > self.rateLimit:
+                self.limited += 1
+                return False
+        return True
+
+
+    def route(self, handler, method, path, query, body):
+        with self.lock:
+            self.requests += 1
+        handler.reply(404)
+
+
+class MockDerash(MockServer):
+    """
+    Stand-in for /biller/customer-bill-data and /biller/customers-paid-bill
+    """
+    def __init__(self, town, paymentsPerDay=0, customers=1000, latency=0.0, errorRate=0.0, rateLimit=0):
+        """
+        :param town: the town prefix of bill_id's
+        :param paymentsPerDay: number of paid bills served for every day of a download
+        :param customers: paid bill id's run from 1 to this number
+        """
+        super().__init__(latency, errorRate, rateLimit)
+        self.town = town
+        self.paymentsPerDay = paymentsPerDay
+        self.customers = max(1, customers)
+        self.bills = {}         # bill_id -> bill as uploaded
+
+
+    def route(self, handler, method, path, query, body):
+        with self.lock:
+            self.requests += 1
+
+        if path == '/biller/customer-bill-data':
+            if method == 'GET':
+                bill = self.bills.get(query.get('bill_id', [''])[0])
+                return handler.reply(404, b'{}') if bill is None else handler.reply(200, json.dumps(bill).encode())
+
+            if method == 'POST':
+                self.bills[body["bill_id"]] = body
+                return handler.reply(201, b'{}')
+
+            if method == 'PUT':
+                if body["bill_id"] not in self.bills:
+                    return handler.reply(404, b'{}')
+                self.bills[body["bill_id"]].update(body)
+                return handler.reply(200, b'{}')
+
+        if path == '/biller/customers-paid-bill' and method == 'GET':
+            return self.paidBills(handler, query)
+
+        handler.reply(404)
+
+
+    def paidBills(self, handler, query):
+        """
+        Stream's the paid bill CSV in chunks, paymentsPerDay rows for each day of the range,
+        gzipped as it goes when the client accepts it
+        """
+        fromDate = date.fromisoformat(query['fromDate'][0])
+        toDate = date.fromisoformat(query['toDate'][0])
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if handler.acceptsGzip() else None
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/csv')
+        handler.send_header('Transfer-Encoding', 'chunked')
+        if compressor is not None:
+            handler.send_header('Content-Encoding', 'gzip')
+        handler.end_headers()
+
+        def write(data):
+            if data:
+                handler.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+        def chunk(lines):
+            data = ''.join(lines).encode()
+            write(data if compressor is None else compressor.compress(data))
+
+        lines = ['payment_date,payer,phone,bill_id,amount,bank,agent,confirmation_code\n']
+        day = fromDate
+        while day <= toDate:
+            for i in range(self.paymentsPerDay):
+                billID = i % self.customers + 1
+                lines.append(f'{day},"Customer, {billID}",09{billID:08d},{self.town}{billID},'
+                             f'{100 + i % 50}.50,CBE,Agent{i % 7},CONF{day:%Y%m%d}{i:06d}\n')
+                if len(lines) >= 1000:
+                    chunk(lines)
+                    lines = []
+            day += timedelta(days=1)
+
+        if lines:
+            chunk(lines)
+        if compressor is not None:
+            write(compressor.flush())
+        handler.wfile.write(b"0\r\n\r\n")
+
+
+class MockWSIS(MockServer):
+    """
+    Stand-in for WSIS CreateUserSession, GetPaymentCenter and receipt posting
+    """
+    def __init__(self, receiptPath, latency=0.0, errorRate=0.0):
+        """
+        :param receiptPath: the path receipts are posted to
+        """
+        super().__init__(latency, errorRate)
+        self.receiptPath = receiptPath
+        self.sessions = 0
+        self.receipts = 0
+
+
+    def route(self, handler, method, path, query, body):
+        with self.lock:
+            self.requests += 1
+
+        if path == '/api/app/server/CreateUserSession':
+            with self.lock:
+                self.sessions += 1
+                session = f"session-{self.sessions}"
+            return handler.reply(200, json.dumps(session).encode())
+
+        if path == '/api/erp/subscribermanagment/GetPaymentCenter':
+            return handler.reply(200, json.dumps({"id": 1, "centerName": "Bronze"}).encode())
+
+        if path == self.receiptPath:
+            with self.lock:
+                self.receipts += 1
+            return handler.reply(200, b'true')
+
+        handler.reply(404)
+
+
+def serve(serverClass, kwargs, ready, stop):
+    """
+    Body of a server process; starts the server, reports its port and serves until stop is set
+    """
+    server = serverClass(**kwargs).start()
+    ready.put(server.port)
+    stop.wait()
+    server.stop()
+
+
+class ServerProcess:
+    """
+    Run's a mock server in a child process so its work and memory don't show up in the
+    measurements of the process being benchmarked
+    """
+    def __init__(self, serverClass, **kwargs):
+        """
+        :param serverClass: MockDerash or MockWSIS
+        :param kwargs: the server's constructor arguments
+        """
+        self.serverClass = serverClass
+        self.kwargs = kwargs
+        self.process = None
+        self.stopping = None
+        self.port = None
+
+
+    def start(self):
+        ready = multiprocessing.Queue()
+        self.stopping = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=serve, args=(self.serverClass, self.kwargs, ready, self.stopping),
+                                               daemon=True)
+        self.process.start()
+        self.port = ready.get(timeout=30)
+        return self
+
+
+    def stop(self):
+        self.stopping.set()
+        self.process.join(10)
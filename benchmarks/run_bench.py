@@ -0,0 +1,249 @@
+# File Desc: Throughput benchmark of Bronze's sync stages against the local stand-in servers in
+#   mock_servers and the synthetic database in fake_iqe. Reports items/sec, p50/p99 request
+#   latency and peak Python memory per stage and size, and saves or compares a baseline file.
+#
+#   python benchmarks/run_bench.py --sizes 1000 10000 --save baseline.json
+#   python benchmarks/run_bench.py --sizes 1000 10000 --compare baseline.json --tolerance 0.2
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'INTAPSBronze'))
+
+from connection_pool import ConnectionPool
+from derash_client import DerashClient
+from payment_ledger import PaymentLedger
+from payment_reader import Payment
+from sync_state import SyncState
+from throttle import Throttle
+from wsis_client import WSISClient, RECEIPT_PATH
+
+from fake_iqe import FakeIQE
+from mock_servers import MockDerash, MockWSIS, ServerProcess
+
+
+TOWN = 'BENCH-'
+STAGES = ('upload', 'upload-warm', 'update', 'invalidate', 'download', 'post')
+
+
+class LatencyRecorder:
+    """
+    Time's every ConnectionPool.send, that is from sending a request to having its response
+    headers (and its body when read whole)
+    """
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+        self.send = ConnectionPool.send
+
+
+    def __enter__(self):
+        recorder = self
+
+        def send(pool, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return recorder.send(pool, *args, **kwargs)
+            finally:
+                with recorder.lock:
+                    recorder.samples.append(time.perf_counter() - start)
+
+        ConnectionPool.send = send
+        return self
+
+
+    def __exit__(self, *exc):
+        ConnectionPool.send = self.send
+
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def measure(func):
+    """
+    Run's func once while recording request latencies and peak memory
+
+    :param func: a callable returning the number of items it handled
+    :return: a dictionary of the measurements
+    """
+    tracemalloc.start()
+    with LatencyRecorder() as recorder:
+        start = time.perf_counter()
+        items = func()
+        elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "items": items,
+        "seconds": round(elapsed, 3),
+        "rate": round(items / elapsed, 1) if elapsed > 0 else 0.0,
+        "requests": len(recorder.samples),
+        "p50": round(recorder.percentile(0.50) * 1000, 3),
+        "p99": round(recorder.percentile(0.99) * 1000, 3),
+        "peakMB": round(peak / 2**20, 2),
+    }
+
+
+def benchSize(size, args, workdir):
+    """
+    Run's every selected stage at one dataset size, stages run in order on the same servers
+    and state file since each builds on the one before (i.e. a warm upload needs a cold one)
+
+    :return: a dictionary of stage name to measurements
+    """
+    results = {}
+    days = max(1, args.days)
+    derash = ServerProcess(MockDerash, town=TOWN, paymentsPerDay=max(1, size // days), customers=size,
+                           latency=args.latency, errorRate=args.error_rate, rateLimit=args.rate_limit).start()
+    wsis = ServerProcess(MockWSIS, receiptPath=RECEIPT_PATH, latency=args.latency,
+                         errorRate=args.error_rate).start()
+
+    path = os.path.join(workdir, f"bench-{size}.db")
+    syncState = SyncState(path)
+    syncState.open()
+    ledger = PaymentLedger(path)
+    ledger.open()
+
+    iqe = FakeIQE(size, deleted=size, days=days)
+    throttle = None
+    if args.throttle_rate > 0:
+        throttle = Throttle(TOWN, rate=args.throttle_rate, maxRate=args.throttle_rate * 10)
+    client = DerashClient('127.0.0.1', 'key', 'secret', TOWN, port=derash.port, workers=args.workers,
+                          syncState=syncState, windowDays=1, secure=False, throttle=throttle)
+    client.connect()
+    wsisClient = WSISClient(ledger=ledger, workers=args.wsis_workers)
+    wsisClient.connect('127.0.0.1', wsis.port)
+
+    def upload():
+        summary = client.uploadDerash(iqe, onResult=lambda result: None)
+        return sum(summary.values())
+
+    def update():
+        iqe.changeAmounts()
+        return upload()
+
+    def download():
+        return sum(1 for _ in client.downloadPayment(iqe))
+
+    def post():
+        wsisClient.startSession('bench', 'bench')
+        payments = (Payment(str(n % size + 1), 100.5, 'Agent', f"BENCH{n:08d}") for n in range(size))
+        return wsisClient.postBillPayment(payments, iqe, 'CASH', 1)
+
+    stages = {
+        'upload': upload,
+        'upload-warm': upload,
+        'update': update,
+        'invalidate': lambda: client.invalidateBill(iqe),
+        'download': download,
+        'post': post,
+    }
+
+    try:
+        for name in STAGES:
+            if name in args.stages:
+                print(f"  {name} ...", end='', flush=True)
+                results[name] = measure(stages[name])
+                print(f" {results[name]['rate']} items/s")
+    finally:
+        client.disconnect()
+        wsisClient.disconnect()
+        syncState.close()
+        ledger.close()
+        derash.stop()
+        wsis.stop()
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare's results against a baseline, a stage regresses when its rate drops or its p99
+    latency or peak memory grows by more than tolerance
+
+    :return: a list of regression messages
+    """
+    regressions = []
+    for size, stages in results.items():
+        for name, now in stages.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+
+            if now["rate"] < before["rate"] * (1 - tolerance):
+                regressions.append(f"{name} @ {size}: rate {before['rate']} -> {now['rate']} items/s")
+            if now["p99"] > before["p99"] * (1 + tolerance) and now["p99"] - before["p99"] > 1:
+                regressions.append(f"{name} @ {size}: p99 {before['p99']} -> {now['p99']} ms")
+            if now["peakMB"] > before["peakMB"] * (1 + tolerance) and now["peakMB"] - before["peakMB"] > 1:
+                regressions.append(f"{name} @ {size}: peak memory {before['peakMB']} -> {now['peakMB']} MB")
+    return regressions
+
+
+def report(results):
+    print(f"{'size':>8} {'stage':<12} {'items':>8} {'items/s':>10} {'requests':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8}")
+    for size, stages in results.items():
+        for name, r in stages.items():
+            print(f"{size:>8} {name:<12} {r['items']:>8} {r['rate']:>10} {r['requests']:>9} "
+                  f"{r['p50']:>8} {r['p99']:>8} {r['peakMB']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Bronze's sync stages against local stand-in servers")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help="number of bills (and payments) per run")
+    parser.add_argument('--stages', nargs='+', default=list(STAGES), choices=STAGES)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every mock request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of mock requests answered with 503")
+    parser.add_argument('--rate-limit', type=int, default=0,
+                        help="requests per second above which the mock Derash answers 429")
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help="requests per second the Derash throttle starts at, 0 for no throttle")
+    parser.add_argument('--workers', type=int, default=8, help="Derash workers")
+    parser.add_argument('--wsis-workers', type=int, default=4, help="WSIS posting lanes")
+    parser.add_argument('--days', type=int, default=10, help="days of payments the download catches up on")
+    parser.add_argument('--save', help="write the results to this baseline file")
+    parser.add_argument('--compare', help="compare the results against this baseline file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.sizes:
+            print(f"Benchmarking {size} bills:")
+            results[str(size)] = benchSize(size, args, workdir)
+
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f"Baseline saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regressions.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
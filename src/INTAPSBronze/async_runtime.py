@@ -0,0 +1,178 @@
+# File Desc: An asyncio runtime for a town's sync stages. The stages run as tasks on one event
+#   loop, so bill upload, invalidation and payment posting overlap on a single thread instead of
+#   a thread each. The blocking calls underneath (pyodbc and the pooled http.client connections)
+#   run on bounded executors, and database reads are prefetched through bounded queues so a
+#   stage sends requests while its next batch of rows is being fetched.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from scheduler import Scheduler
+
+
+def take(items, size):
+    """
+    :param items: an iterator
+    :param size: the number of items to take
+    :return: a list of up to size items, empty once the iterator is exhausted
+    """
+    return list(islice(items, size))
+
+
+async def stream(items, size=1, depth=2, reader=None):
+    """
+    Iterate's a blocking iterable (i.e. rows streaming from the database) from the event loop.
+    Items are read size at a time on a single thread and up to depth reads are kept ahead of
+    the consumer in a bounded queue. The iterable is closed on that thread when the stream
+    ends or is closed early.
+
+    :param items: the blocking iterable
+    :param size: items per read
+    :param depth: reads kept ahead of the consumer
+    :param reader: the single thread executor to read on (i.e. the one owning the database
+        connection the rows come from), a thread of the stream's own if None
+    """
+    loop = asyncio.get_running_loop()
+    items = iter(items)
+    owned = reader is None
+    if owned:
+        reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bronze-stream")
+    queue = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        try:
+            while True:
+                chunk = await loop.run_in_executor(reader, take, items, size)
+                await queue.put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            await queue.put(e)
+
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            chunk = await queue.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            for item in chunk:
+                yield item
+    finally:
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+        if hasattr(items, 'close'):
+            await loop.run_in_executor(reader, items.close)
+        if owned:
+            reader.shutdown(wait=False)
+
+
+async def mapConcurrent(items, func, executor, workers):
+    """
+    Applies a blocking func to every item of an async stream on an executor and yield's the
+    results in order. Like DerashClient.runConcurrent only a couple of items per worker are
+    in flight, and closing the generator early waits for those and closes items.
+
+    :param items: an async iterable, i.e. a stream
+    :param func: the function to apply, it runs on the executor
+    :param executor: the executor to run func on
+    :param workers: the number of concurrent calls, at most the executor's threads
+    """
+    loop = asyncio.get_running_loop()
+    inFlight = deque()
+    try:
+        async for item in items:
+            inFlight.append(loop.run_in_executor(executor, func, item))
+            if len(inFlight) >= workers * 2:
+                yield await inFlight.popleft()
+
+        while inFlight:
+            yield await inFlight.popleft()
+    finally:
+        if inFlight:
+            await asyncio.wait(inFlight)
+        if hasattr(items, 'aclose'):
+            await items.aclose()
+
+
+class AsyncScheduler(Scheduler):
+    """
+    Run's every stage as a task on an event loop of its own thread, with the same pacing as
+    Scheduler (see Stage.finish). A stage's func must return an awaitable.
+    """
+    def __init__(self, name=""):
+        """
+        :param name: used to name the loop's thread, i.e. the town
+        """
+        super().__init__()
+        self.name = name
+        self.loop = None
+        self.wakeup = None      # asyncio.Event set on stop to cut the stages' delays short
+
+
+    async def loopAsync(self, stage):
+        """
+        The body of a stage task; run's the stage, waits its delay and repeats until stopped
+        """
+        while not self.stopping.is_set():
+            start = time.monotonic()
+            try:
+                work = await stage.func() or 0
+                error = None
+            except Exception as e:
+                work = 0
+                error = e
+            stage.finish(start, work, error)
+
+            if stage.delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), stage.delay)
+                except asyncio.TimeoutError:
+                    pass
+
+
+    def runLoop(self):
+        """
+        The body of the loop thread; run's the stage tasks until every one of them has stopped
+        """
+        async def main():
+            await asyncio.gather(*(self.loopAsync(stage) for stage in self.stages))
+
+        try:
+            self.loop.run_until_complete(main())
+        finally:
+            self.loop.close()
+
+
+    def start(self):
+        """
+        Start's the event loop thread, stages run immediately
+        """
+        self.loop = asyncio.new_event_loop()
+        self.wakeup = asyncio.Event()
+        thread = threading.Thread(target=self.runLoop, name=f"bronze-{self.name}loop", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+
+    def stop(self, timeout=None):
+        """
+        Signal's every stage to stop and waits for the ones running to finish
+
+        :param timeout: seconds to wait for the loop thread
+        """
+        self.stopping.set()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.wakeup.set)
+            except RuntimeError:
+                pass        # the loop is already closed
+        super().stop(timeout)
@@ -0,0 +1,404 @@
+# File Desc: A small pool of keep-alive http.client connections that can be shared among
+#   worker threads talking to the same host (i.e. INSA Derash or WSIS). It weeds out sockets
+#   the server has closed, reconnects and retries idempotent requests on network errors,
+#   reuses TLS sessions so reconnecting is cheap and decodes gzip/deflate response bodies.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import http.client
+import io
+import select
+import ssl
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from metrics import registry
+from throttle import THROTTLED, parseRetryAfter
+
+
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS')
+
+# errors after which a fresh connection may succeed
+NETWORK_ERRORS = (OSError, http.client.HTTPException)
+
+# the content codings responses are decoded from, for clients to send as Accept-Encoding
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+def decompressor(encoding, raw=False):
+    """
+    :param encoding: a Content-Encoding header
+    :param raw: True for deflate data without the zlib header, which some servers send
+    :return: a zlib decompress object for the encoding, None for identity
+    """
+    encoding = (encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        return zlib.decompressobj(-zlib.MAX_WBITS if raw else zlib.MAX_WBITS)
+    if encoding == 'identity':
+        return None
+    raise http.client.HTTPException(f"unsupported Content-Encoding {encoding}")
+
+
+def decodeBody(res, data):
+    """
+    :param res: a response whose body has been read whole
+    :param data: the body as bytes
+    :return: the body decoded from its Content-Encoding
+    """
+    encoding = res.getheader('Content-Encoding')
+    decoder = decompressor(encoding)
+    if decoder is None or len(data) == 0:
+        return data
+    try:
+        return decoder.decompress(data) + decoder.flush()
+    except zlib.error:
+        if encoding.strip().lower() != 'deflate':
+            raise
+        decoder = decompressor(encoding, raw=True)
+        return decoder.decompress(data) + decoder.flush()
+
+
+class DecodedReader(io.RawIOBase):
+    """
+    Decompresses a response body as it is read. Compressed bytes are read from the response
+    into one reusable buffer and inflated straight into the caller's buffer, so no more than
+    a chunk of either is held at a time.
+    """
+    def __init__(self, res, encoding, chunkSize=65536):
+        """
+        :param res: an unread response
+        :param encoding: its Content-Encoding, gzip or deflate
+        :param chunkSize: bytes of compressed data read from the response at a time
+        """
+        self.res = res
+        self.encoding = encoding
+        self.decoder = decompressor(encoding)
+        self.buffer = bytearray(chunkSize)
+        self.view = memoryview(self.buffer)
+        self.tail = b''                 # compressed input left over by the last call
+        self.rest = b''                 # inflated output of the final flush not handed out yet
+        self.started = False
+        self.eof = False
+
+
+    def readable(self):
+        return True
+
+
+    def inflate(self, data, size):
+        try:
+            return self.decoder.decompress(data, size)
+        except zlib.error:
+            # a deflate body without the zlib header, only detectable on its first bytes
+            if self.started or self.encoding.strip().lower() != 'deflate':
+                raise
+            self.decoder = decompressor(self.encoding, raw=True)
+            return self.decoder.decompress(data, size)
+
+
+    def readinto(self, b):
+        size = len(b)
+        while not self.rest:
+            if self.tail:
+                data = self.tail
+            elif self.eof:
+                return 0
+            else:
+                count = self.res.readinto(self.buffer)
+                if count == 0:
+                    self.eof = True
+                    self.rest = self.decoder.flush()
+                    continue
+                data = self.view[:count]
+
+            out = self.inflate(data, size)
+            self.started = True
+            self.tail = self.decoder.unconsumed_tail
+            if out:
+                b[:len(out)] = out
+                return len(out)
+
+        out, self.rest = self.rest[:size], self.rest[size:]
+        b[:len(out)] = out
+        return len(out)
+
+
+def responseStream(res, bufferSize=65536):
+    """
+    :param res: an unread response, i.e. from ConnectionPool.streaming
+    :return: a binary file like object of the response body decoded from its Content-Encoding,
+        the response itself when it is not encoded
+    """
+    encoding = res.getheader('Content-Encoding')
+    if decompressor(encoding) is None:
+        return res
+    return io.BufferedReader(DecodedReader(res, encoding), bufferSize)
+
+
+class TLSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection that resumes the TLS session last negotiated by its pool, a reconnect
+    then costs an abbreviated handshake instead of a full one
+    """
+    def __init__(self, pool):
+        super().__init__(pool.host, pool.port, timeout=pool.timeout, context=pool.context)
+        self.pool = pool
+
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        serverHostname = self._tunnel_host if self._tunnel_host else self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=serverHostname,
+                                              session=self.pool.tlsSession)
+
+
+class ConnectionPool:
+    """
+    Keeps a bounded number of keep-alive connections to a single host so several worker
+    threads can make requests at the same time, each on a connection of its own
+    """
+    def __init__(self, host, port, size=1, secure=True, timeout=None, retries=3, backoff=0.5,
+                 maxBackoff=8, maxIdle=60, throttle=None):
+        """
+        :param host: the host domain or ip address to connect to
+        :param port: the port number for the host
+        :param size: the maximum number of connections kept open at once
+        :param secure: True for HTTPS connections, False for plain HTTP
+        :param timeout: socket timeout in seconds, None to block forever
+        :param retries: number of times an idempotent request is retried on a network error
+        :param backoff: seconds to wait before the second retry, doubled for every retry after
+        :param maxBackoff: upper bound of the wait between retries
+        :param maxIdle: seconds a connection may sit idle before it is considered stale
+        :param throttle: a Throttle pacing the requests, None to send them as they come
+        """
+        self.host = host
+        self.port = port
+        self.size = max(1, int(size))
+        self.secure = secure
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.maxIdle = maxIdle
+        self.throttle = throttle
+
+        self.context = ssl.create_default_context() if secure else None
+        self.tlsSession = None          # last TLS session, resumed by new connections
+
+        self.idle = []                  # (connection, time it went idle) waiting to be borrowed
+        self.created = 0                # connections alive (idle or borrowed)
+        self.reconnects = 0             # stale or broken connections replaced so far
+        self.cond = threading.Condition()
+
+
+    def newConnection(self):
+        """
+        Creates a fresh connection object, the socket itself is opened lazily on first request
+        """
+        if self.secure:
+            return TLSConnection(self)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+
+    def isStale(self, conn, idleSince):
+        """
+        Checks whether an idle connection can still be used. A socket that has been idle too
+        long or that is readable while no request is pending (the server closed it or sent
+        something unexpected) is stale.
+
+        :return: True if the connection should be thrown away
+        """
+        if conn.sock is None:
+            return False        # never opened or already closed, it connects on next use
+        if time.monotonic() - idleSince > self.maxIdle:
+            return True
+
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return len(readable) > 0
+
+
+    def acquire(self):
+        """
+        Borrow's a connection from the pool, blocks until one is available if the pool
+        has already grown to its size. Stale idle connections are closed and replaced.
+
+        :return: a connection object, which must be handed back using release
+        """
+        with self.cond:
+            while True:
+                while not self.idle and self.created >= self.size:
+                    self.cond.wait()
+
+                if not self.idle:
+                    self.created += 1
+                    break
+
+                conn, idleSince = self.idle.pop()
+                if not self.isStale(conn, idleSince):
+                    return conn
+
+                conn.close()
+                self.created -= 1
+                self.reconnects += 1
+
+        try:
+            return self.newConnection()
+        except Exception:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+
+    def release(self, conn, discard=False):
+        """
+        Return's a borrowed connection back to the pool
+
+        :param conn: the connection object from acquire
+        :param discard: True to close the connection instead of keeping it for reuse
+        """
+        if discard:
+            conn.close()
+        elif self.secure and isinstance(conn.sock, ssl.SSLSocket) and conn.sock.session is not None:
+            self.tlsSession = conn.sock.session
+
+        with self.cond:
+            if discard:
+                self.created -= 1
+            else:
+                self.idle.append((conn, time.monotonic()))
+            self.cond.notify()
+
+
+    def retryDelay(self, attempt):
+        """
+        :param attempt: the retry number starting at 1
+        :return: seconds to wait before a retry, the first one is immediate since it most likely
+            follows a connection the server had already dropped
+        """
+        if attempt <= 1:
+            return 0
+        return min(self.backoff * 2 ** (attempt - 2), self.maxBackoff)
+
+
+    def send(self, method, url, body, headers, read):
+        """
+        Send's a request and gets the response on a pooled connection. On a network error the
+        connection is replaced and idempotent requests are retried with exponential backoff;
+        other requests are only sent once as the server may already have acted on them.
+        A 429 (the request was refused, any method) or a 503 to an idempotent request is
+        retried too, after its Retry-After or the backoff, paced by the throttle if there is one.
+
+        :param read: True to read the whole body before returning
+        :return: a tuple of connection, response and body (None when read is False)
+        """
+        endpoint = url.split('?')[0]
+        attempt = 0
+        while True:
+            if self.throttle is not None:
+                self.throttle.acquire(endpoint)
+            conn = self.acquire()
+            start = time.perf_counter()
+            try:
+                conn.request(method, url, body=body, headers=headers or {})
+                res = conn.getresponse()
+                retryAfter = res.getheader('Retry-After')
+                if self.throttle is not None:
+                    self.throttle.feedback(endpoint, res.status, retryAfter)
+
+                if (res.status in THROTTLED and attempt < self.retries and
+                        (res.status == 429 or method in IDEMPOTENT)):
+                    res.read()      # drain so the connection can be reused
+                    self.record(method, endpoint, res.status, start)
+                    self.release(conn, discard=res.will_close)
+                    attempt += 1
+                    if self.throttle is None:
+                        time.sleep(max(parseRetryAfter(retryAfter) or 0, self.retryDelay(attempt)))
+                    continue
+
+                data = res.read() if read else None
+                self.record(method, endpoint, res.status, start)
+                return conn, res, data
+            except NETWORK_ERRORS:
+                self.release(conn, discard=True)
+                self.record(method, endpoint, 'error', start)
+                with self.cond:
+                    self.reconnects += 1
+
+                attempt += 1
+                if method not in IDEMPOTENT or attempt > self.retries:
+                    raise
+                time.sleep(self.retryDelay(attempt))
+            except Exception:
+                self.release(conn, discard=True)
+                raise
+
+
+    def record(self, method, endpoint, status, start):
+        """
+        Add's a request to the latency and status metrics of its endpoint
+        """
+        registry.observe("bronze_http_request_seconds", time.perf_counter() - start,
+                         host=self.host, method=method, endpoint=endpoint)
+        registry.inc("bronze_http_requests_total", host=self.host, endpoint=endpoint, status=status)
+
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send's a request on a pooled connection and reads the whole response body so the
+        connection is ready for the next request before it goes back to the pool. The body
+        is decoded if the server compressed it.
+
+        :param method: the HTTP verb
+        :param url: the path and query string
+        :param body: request body if any
+        :param headers: dictionary of request headers
+        :return: a tuple of the response object and its body as bytes
+        """
+        conn, res, data = self.send(method, url, body, headers, True)
+        self.release(conn, discard=res.will_close)
+        return res, decodeBody(res, data)
+
+
+    @contextmanager
+    def streaming(self, method, url, body=None, headers=None):
+        """
+        Send's a request on a pooled connection and hands the unread response to the caller
+        so the body can be parsed as it arrives. The connection goes back to the pool only
+        if the body was read to the end, otherwise it is discarded. The response is not
+        decoded, read it through responseStream.
+
+        :param method: the HTTP verb
+        :param url: the path and query string
+        :param body: request body if any
+        :param headers: dictionary of request headers
+        """
+        conn, res, _ = self.send(method, url, body, headers, False)
+        try:
+            yield res
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+
+        self.release(conn, discard=res.will_close or not res.isclosed())
+
+
+    def close(self):
+        """
+        Closes all idle connections in the pool
+        """
+        with self.cond:
+            idle, self.idle = self.idle, []
+            self.created -= len(idle)
+            self.cond.notify_all()
+
+        for conn, _ in idle:
+            conn.close()
@@ -8,7 +8,14 @@
 # Date Created: 21st of Septemeber 2024, Saturday
 import http.client
 import json
-from datetime import datetime
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from connection_pool import ACCEPT_ENCODING, ConnectionPool, responseStream
+from metrics import registry
+from payment_reader import readPayments
 
 
 
@@ -16,7 +23,9 @@ class DerashClient:
     """
     Orgranizes all the functions we need to exchange information with Derash
     """
-    def __init__(self, domain, apiKey, apiSecret, town, port=http.client.HTTPS_PORT):
+    def __init__(self, domain, apiKey, apiSecret, town, port=http.client.HTTPS_PORT, workers=1, syncState=None,
+                 windowDays=1, negativeTTL=3600, secure=True, outbox=None, sweepInterval=86400, throttle=None,
+                 sweepWindow=100000, timeout=30):
         """
         Read's Derash connection parameters from app.config file (JSON format)
         and starts an https connection with Derash
@@ -26,11 +35,32 @@ class DerashClient:
         :param apiSecret: the Secret key that is paired with apiKey
         :param town: the town for the utility
         :param port: the https port default 443
+        :param workers: number of concurrent uploads, also the size of the connection pool
+        :param syncState: an opened SyncState index used to skip unchanged bills, None to check every bill
+        :param windowDays: number of days per payment download window when catching up
+        :param negativeTTL: seconds a bill set not found on Derash is remembered as missing
+        :param secure: False to talk plain HTTP, i.e. to a local stand-in of Derash
+        :param outbox: an opened Outbox journaling every POST/PUT, None to send without one
+        :param sweepInterval: seconds between invalidation passes over every tombstone, 0 for never
+        :param throttle: a Throttle shared by the town's Derash clients, None to send without pacing
+        :param sweepWindow: bill ids below the tombstone watermark a sweep goes back over, 0 for all
+        :param timeout: seconds a socket read or connect may block before the request fails
         """
         self.domain = domain
         self.port = port
-        self.conn = None
+        self.pool = None
         self.town = town
+        self.workers = max(1, int(workers))
+        self.syncState = syncState
+        self.windowDays = max(1, int(windowDays))
+        self.negativeTTL = negativeTTL
+        self.secure = secure
+        self.outbox = outbox
+        self.sweepInterval = sweepInterval
+        self.sweepWindow = sweepWindow
+        self.timeout = timeout
+        self.throttle = throttle
+        self.executor = None    # worker threads of the asyncio runtime, see async_runtime
         self.state = False      # a connection state
 
         self.headers = {
@@ -38,14 +68,18 @@ class DerashClient:
             'api-key':f'{apiKey}',
             'api-secret':f'{apiSecret}',
             'connection':'keep-alive',
+            'accept-encoding':ACCEPT_ENCODING,
         }
     
 
     def connect(self):
         """
-        Start's HTTPS connection with derash router and returns it's connection 
+        Start's a pool of HTTPS keep-alive connections with derash router, the sockets
+        are opened on first use by each worker
         """
-        self.conn = http.client.HTTPSConnection(self.domain, self.port)
+        self.pool = ConnectionPool(self.domain, self.port, self.workers, secure=self.secure, timeout=self.timeout,
+                                   throttle=self.throttle)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f"bronze-{self.town}derash")
         self.state = True
     
     
@@ -54,37 +88,229 @@ class DerashClient:
         Tear's down the active connection
         """
         if self.state:
-            self.conn.close()
+            self.executor.shutdown(wait=True)
+            self.pool.close()
 
         self.state = False
 
 
-    def uploadDerash(self, iqe):
+    def request(self, method, url, body=None, meta=None):
+        """
+        Send's a request to Derash on one of the pooled connections, the response is read
+        whole so the connection can be reused right away. POST and PUT requests are journaled
+        in the outbox until their response arrives.
+
+        :param method: the HTTP verb
+        :param url: the path and query string of the Derash API
+        :param body: a JSON serializable object to send as request body
+        :param meta: kept in the outbox entry to finish the job if the request is replayed
+        :return: a tuple of response status and response body as bytes (json.loads takes them as is)
+        """
+        entryID = None
+        if self.outbox is not None and method in ('POST', 'PUT'):
+            entryID = self.outbox.append('derash', method, url, body, meta)
+
+        status = None
+        try:
+            res, data = self.pool.request(method, url, body=None if body is None else json.dumps(body),
+                                          headers=self.headers)
+            status = res.status
+        finally:
+            # a request that raised is not replayed; the bill isn't recorded in the sync state
+            # so the next pass syncs it again
+            if entryID is not None:
+                self.outbox.done(entryID, status)
+        return status, data
+
+
+    def replayOutbox(self):
+        """
+        Finishes the POST/PUT requests that were in flight when Bronze last stopped, so a
+        restart costs a request per unfinished write rather than a resync. A PUT sets values
+        and is sent again as is; a new bill is only posted if Derash doesn't have it yet.
+        Bills are then recorded in the sync state as the original call would have done.
+
+        :return: the number of requests replayed
+        """
+        if self.outbox is None:
+            return 0
+
+        replayed = 0
+        for entry in self.outbox.pending('derash'):
+            method, url, body, meta = entry["method"], entry["url"], entry["body"], entry["meta"]
+            try:
+                status = None
+                if method == 'POST' and self.lookupBill(body['bill_id']) is not None:
+                    status = 200
+                if status is None:
+                    res, _ = self.pool.request(method, url, body=json.dumps(body), headers=self.headers)
+                    status = res.status
+            except Exception as e:
+                print(f"Bronze: replaying {method} {url} failed, it stays in the outbox: {e}")
+                continue
+
+            if status < 300 and self.syncState is not None and meta.get("digest") is not None:
+                self.syncState.rememberDerashID(self.town, str(meta["billID"]).split(','), meta["derashID"])
+                self.syncState.record(self.town, meta["billID"], meta["derashID"], meta["amount"],
+                                      meta["dueDate"], meta["digest"])
+            self.outbox.done(entry["id"], status)
+            replayed += 1
+
+        if replayed > 0:
+            print(f"Bronze: {self.town} replayed {replayed} unfinished Derash request(s).")
+        return replayed
+
+
+    def runConcurrent(self, func, items, workers):
         """
-        Reterives a list of unpaid bills from the database, and foreach bill found it 
-        checks derash router for the bill info, updates bill changes if any, finally uploads
-        bills to derash
+        Applies func to every item on a pool of worker threads and yield's the results in
+        order. Only a couple of items per worker are in flight at a time, so items can be
+        a generator streaming from the database without it being read into memory.
+
+        :param func: the function to apply, it runs on worker threads
+        :param items: an iterable of items
+        :param workers: number of worker threads, 1 runs everything on the calling thread
+        """
+        if workers == 1:
+            for item in items:
+                yield func(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            inFlight = deque()
+            for item in items:
+                inFlight.append(executor.submit(func, item))
+                if len(inFlight) >= workers * 2:
+                    yield inFlight.popleft().result()
+
+            while inFlight:
+                yield inFlight.popleft().result()
+
+
+    def uploadDerash(self, iqe, workers=None, onResult=None, limit=None):
+        """
+        Reterives the unpaid bills from the database, and foreach bill found it checks
+        derash router for the bill info, updates bill changes if any, finally uploads
+        bills to derash. Bills are streamed from the database and synced as they arrive,
+        concurrently when more than one worker is used; database access stays on the
+        calling thread.
 
         :param iqe: an instance of database engine, uses it to query the database for bill info
+        :param workers: number of concurrent uploads, defaults to the one set at construction
+        :param onResult: optional callback receiving the result of each bill (see syncBill)
+        :param limit: stop after this many bills needed a request to Derash (skipped bills don't count),
+            the rest are picked up by the next call
+        :return: a dictionary of the number of bills per action
         """
-        # get a list-of-all the unpaid bills
-        bills = iqe.getUnpaidBills()
         period = iqe.getCurrentPeriod()
-        dueDate = iqe.getDueDate(period)
+        dueDate = iqe.getDueDate()
+        workers = min(workers or self.workers, self.workers)
+
+        print(f"Uploading bills to Derash API using {workers} worker(s).")
+
+        summary = {}
+        synced = 0
+        exhausted = True
+        sync = lambda bill: self.syncBill(bill, period, dueDate)
+        bills = iqe.iterUnpaidBills()
+        results = self.runConcurrent(sync, bills, workers)
+        for result in results:
+            if self.tally(summary, result, onResult):
+                synced += 1
+                if limit is not None and synced >= limit:
+                    exhausted = False
+                    break
+
+        results.close()
+        bills.close()
+        self.finishUpload(iqe, summary, exhausted)
+        return summary
+
+
+    def tally(self, summary, result, onResult=None):
+        """
+        Count's the result of a bill in an upload summary and hands it to onResult
+
+        :param summary: the dictionary of the number of bills per action
+        :param result: a result from syncBill
+        :param onResult: the callback given to the upload, None to print failures
+        :return: True if the bill needed a request to Derash
+        """
+        summary[result["action"]] = summary.get(result["action"], 0) + 1
+        if onResult is not None:
+            onResult(result)
+        elif result["action"] == "failed":
+            print(f"Derash upload failed for bill {result['billID']}: {result['error']}")
+        return result["action"] != "skipped"
 
-        print(f"Uploading {len(bills)} bills to Derash API.")
 
-        for bill in bills:
+    def finishUpload(self, iqe, summary, exhausted):
+        """
+        Wrap's up an upload pass once the bill stream is closed
+
+        :param iqe: the database engine the bills came from
+        :param summary: the dictionary of the number of bills per action
+        :param exhausted: False if the pass stopped at its limit before the last bill
+        """
+        if self.syncState is not None:
+            self.syncState.commit()
+
+        # failed and left over bills are picked up on the next pass, so only move the watermark
+        # when every bill was synced
+        if exhausted and "failed" not in summary:
+            iqe.commitWatermark()
+        # an incremental pass only sees the customers that changed, not the unpaid backlog
+        if exhausted and iqe.pendingFullScan:
+            registry.set("bronze_unpaid_bills", sum(summary.values()), town=self.town)
+            # the reconcile stage waits for the sync state to have seen every unpaid bill once
+            if self.syncState is not None:
+                self.syncState.setCursor(self.town + 'fullUpload', time.time())
+        print(f"Derash upload done: {summary}")
+
+
+    def syncBill(self, bill, period, dueDate):
+        """
+        Syncs a single bill with Derash, updates it if Derash already knows of it or else
+        uploads it as new. Bills whose content is the same as the last upload recorded
+        in the sync state index are skipped without a network call. Errors are caught and
+        reported per bill so that one bad bill does not stop the rest.
+
+        :param bill: the bill info to sync
+        :param period: the current bill period
+        :param dueDate: the last allowed payment date by Derash
+        :return: a dictionary with billID, action (new, update, unchanged, skipped or failed),
+            the HTTP status, the bill's amount and Derash bill_id and an error message if any
+        """
+        result = {"billID": bill.billID, "action": "failed", "status": None, "error": None,
+                  "amount": bill.amount, "derashID": None}
+        try:
+            digest = None
+            if self.syncState is not None:
+                digest = self.syncState.digest(bill, period, dueDate)
+                if self.syncState.isUnchanged(self.town, bill.billID, digest):
+                    result["action"] = "skipped"
+                    return result
+
             derashBill = self.getBillDerash(bill)
-            #print(derashBill)
             if len(derashBill) != 0:
-                self.updateDerash(bill, derashBill, dueDate)
-                continue
+                result["derashID"] = derashBill["bill_id"]
+                result["status"] = self.updateDerash(bill, derashBill, dueDate, digest)
+                result["action"] = "unchanged" if result["status"] is None else "update"
+            else:
+                result["derashID"] = self.town + str(bill.billID).split(',')[0]
+                result["status"] = self.uploadNewDerash(bill, period, dueDate, digest)
+                result["action"] = "new"
 
-            self.uploadNewDerash(bill, period, dueDate)
+            if result["status"] is not None and result["status"] >= 300:
+                result["action"] = "failed"
+                result["error"] = f"Derash responded with {result['status']}"
+        except Exception as e:
+            result["error"] = str(e)
+
+        return result
 
     
-    def updateDerash(self, sysBill, derashBill, dueDate):
+    def updateDerash(self, sysBill, derashBill, dueDate, digest=None):
         """
         A previously uploaded bill if not already paid maybe updated from the Utility System
         which is WSIS, in such cases the bill needs to be updated accordingly using the 
@@ -93,54 +319,110 @@ class DerashClient:
         :param sysBill: the bill info to update
         :param derashBill: the bill from derash to comapre to and update
         :param dueDate: the last allowed payment date (Derash stuff...)
+        :param digest: content hash of sysBill, when given the sync state index is updated once the
+            PUT succeeded or when Derash already has the bill as it is; a bill left different (i.e.
+            another customer's, or paid on Derash) is not recorded and is checked again next pass
+        :return: the HTTP status of the update or None if there was nothing to update
         """
-        if sysBill["customerCode"] == derashBill["customer_id"] or sysBill["contractNo"] == derashBill["customer_id"]:
-            if round(sysBill["amount"], 2) - round(derashBill["amount_due"], 2) >= 0.1:
+        status = None
+        sameCustomer = sysBill.customerCode == derashBill["customer_id"] or sysBill.contractNo == derashBill["customer_id"]
+        matches = (sameCustomer and not derashBill.get("already_paid") and
+                   abs(round(float(sysBill.amount), 2) - round(derashBill["amount_due"], 2)) < 0.01)
+        if sameCustomer:
+            # a raise is sent even to a bill paid on Derash (the customer got new bills), a drop
+            # (i.e. a reading correction or a deleted bill) only while it's still payable
+            change = round(float(sysBill.amount), 2) - round(derashBill["amount_due"], 2)
+            if change >= 0.1 or (change <= -0.01 and not derashBill.get("already_paid")):
                 updateBill = {
                     "bill_id": derashBill["bill_id"],
                     "bill_desc": derashBill["bill_desc"],
                     "reason": "Updated from utility system",
                     "already_paid": False,
-                    "amount_due": sysBill["amount"],
+                    "amount_due": round(float(sysBill.amount), 2),
                     "due_date": dueDate.strftime("%Y-%m-%d")
                 }
-                self.conn.request('PUT', '/biller/customer-bill-data', body=json.dump(updateBill))
-                res = self.conn.getresponse()
-                res.read().decode('utf-8')  # discard
+                status, _ = self.request('PUT', '/biller/customer-bill-data', updateBill,
+                                         self.journalMeta(sysBill, derashBill["bill_id"], dueDate, digest))
+
+        inSync = status < 300 if status is not None else matches
+        if digest is not None and self.syncState is not None and inSync:
+            self.syncState.record(self.town, sysBill.billID, derashBill["bill_id"],
+                                  sysBill.amount, dueDate, digest)
+        return status
     
 
-    def getBillDerash(self, bill):
+    def getBillDerash(self, bill, exact=False):
         """
-        Get's the bill info provided by parameter bill from INSA Derash API.
+        Get's the bill info provided by parameter bill from INSA Derash API. The Derash bill_id
+        each WSIS bill was last known by is cached in the sync state index, so a known customer
+        costs a single request even after new bills were added to it; a bill set Derash had
+        none of is remembered for negativeTTL seconds and costs no request at all. Otherwise
+        every id is tried in turn.
         
         :param bill: the bill info to reterive
+        :param exact: True to only look for the Derash bill uploaded under bill's own id(s), the
+            caches are neither read nor written. A tombstone must not resolve to the live Derash
+            bill of the customer its bill belonged to.
         :return: empty object if bill does not exist on derash
         """
-        billIDs = str(bill["billID"]).split(',')
+        billIDs = str(bill.billID).split(',')
+        if self.syncState is not None and not exact:
+            derashID = self.syncState.findDerashID(self.town, billIDs)
+            if derashID is not None:
+                derashBill = self.lookupBill(derashID)
+                if derashBill is not None:
+                    self.syncState.rememberDerashID(self.town, billIDs, derashID)
+                    return derashBill
+                self.syncState.forgetDerashID(self.town, derashID)
+            elif self.syncState.isKnownMiss(self.town, bill.billID):
+                return {}
+
         for id in billIDs:
             billID = self.town + id 
-            self.conn.request
-            self.conn.request('GET', f"/biller/customer-bill-data?bill_id={billID}", headers=self.headers)
-            res = self.conn.getresponse()
+            derashBill = self.lookupBill(billID)
+            if derashBill is not None:
+                if self.syncState is not None and not exact:
+                    self.syncState.rememberDerashID(self.town, billIDs, billID)
+                return derashBill
 
-            if res.status == 200:
-                return json.loads(res.read().decode('utf-8'))
-
-        res.read().decode('utf-8')  # ignore  
+        if self.syncState is not None and not exact:
+            self.syncState.rememberMiss(self.town, bill.billID, self.negativeTTL)
         return {}
-    
-        # billID = self.town + str(bill["billID"]).split(',')[0]
-        # self.conn.request('GET', f"/biller/customer-bill-data?bill_id={billID}", headers=self.headers)
-        # res = self.conn.getresponse()
-        # result = json.loads(res.read().decode('utf-8'))
-
-        # if res.status == 200:
-        #     return result
-        # else: # we don't really care about other codes...
-        #     return {}
+
+
+    def lookupBill(self, derashID):
+        """
+        Get's a single bill from Derash by its bill_id. Only a 404 means Derash doesn't have the
+        bill; any other answer (i.e. a 503 still failing after the pool's retries) raises, so
+        the caches are left as they are and the bill fails rather than being posted again.
+
+        :param derashID: the Derash bill_id
+        :return: the Derash bill, None if Derash doesn't have it
+        """
+        status, result = self.request('GET', f"/biller/customer-bill-data?bill_id={derashID}")
+        if status == 200:
+            return json.loads(result)
+        if status == 404:
+            return None
+        raise http.client.HTTPException(f"Derash lookup of bill {derashID} failed with status {status}")
+
+
+    def getBillsDerash(self, bills, workers=None):
+        """
+        Batch version of getBillDerash, resolves the Derash bills of many customers at once
+        over the pooled connections. Derash has no multi bill query, so each lookup is still
+        a request (or none when cached) but they run concurrently.
+
+        :param bills: a list of bills
+        :param workers: number of concurrent lookups, defaults to the one set at construction
+        :return: a dictionary mapping each bill's billID to its Derash bill (empty if not on Derash)
+        """
+        workers = min(workers or self.workers, self.workers, max(1, len(bills)))
+        found = self.runConcurrent(self.getBillDerash, bills, workers)
+        return {bill.billID: derashBill for bill, derashBill in zip(bills, found)}
         
 
-    def uploadNewDerash(self, bill, period, dueDate):
+    def uploadNewDerash(self, bill, period, dueDate, digest=None):
         """
         Upload's the newly generated or not synced bills to INSA Derash. Since function is run
         after checking if bill exists in INSA Derash DB, we are sure this bill does not exist
@@ -148,61 +430,267 @@ class DerashClient:
         :param bill: the new bill data to upload to Derash
         :param period: the current bill period
         :param dueDat: the last allowed payment date by Derash
+        :param digest: content hash of bill, when given the sync state index is updated on success
+        :return: the HTTP status of the upload
         """
         uploadBill = {
-            "bill_id": self.town + str(bill.billID).split('')[0],
+            "bill_id": self.town + str(bill.billID).split(',')[0],
             "bill_desc": "bills upto " + period,
             "reason": "bills upto " + period,
-            "amount_due": round(bill["amount"], 2),
+            "amount_due": round(float(bill.amount), 2),
             "due_date": dueDate.strftime("%Y-%m-%d"),
             "partial_pay_allowed": False,
-            "customer_id": bill["customerCode"],
-            "name": bill["name"],
-            "mobile": bill["phoneNo"],
-            "email": bill["email"]
+            "customer_id": bill.customerCode,
+            "name": bill.name,
+            "mobile": bill.phoneNo,
+            "email": bill.email
         }
-        self.conn.request('POST', "/biller/customer-bill-data", headers=self.headers, body=json.dumps(uploadBill))
-        res = self.conn.getresponse()
-        print(res.read().decode('utf-8'))
+        status, _ = self.request('POST', "/biller/customer-bill-data", uploadBill,
+                                 self.journalMeta(bill, uploadBill["bill_id"], dueDate, digest))
 
+        if self.syncState is not None and status < 300:
+            self.syncState.rememberDerashID(self.town, str(bill.billID).split(','), uploadBill["bill_id"])
+            if digest is not None:
+                self.syncState.record(self.town, bill.billID, uploadBill["bill_id"],
+                                      bill.amount, dueDate, digest)
+        return status
 
-    def invalidateBill(self, iqe):
+
+    def journalMeta(self, bill, derashID, dueDate, digest):
+        """
+        :return: what replayOutbox needs to record a bill in the sync state, None without an outbox
+        """
+        if self.outbox is None:
+            return None
+        return {"billID": str(bill.billID), "derashID": derashID, "amount": round(float(bill.amount), 2),
+                "dueDate": str(dueDate), "digest": digest}
+
+
+    def invalidateBill(self, iqe, workers=None, batchSize=500):
         """
         Removes/deactivates all deleted bills by WSIS users to INSA Derash domain. The trick is to look
         into *_Deleted tables and if corresponding id is found in INSA Derash and remove it!
+        Only tombstones above the watermark kept in the sync state are read, so a run costs
+        requests for the bills deleted since the last run rather than the whole history. Bills
+        are invalidated concurrently and the watermark is committed every batchSize bills.
 
         :param iqe: an object of db interface, used to run qryUnpaidBillsDeleted
+        :param workers: number of concurrent invalidations, defaults to the one set at construction
+        :param batchSize: tombstones between watermark commits
+        :return: the number of bills invalidated
         """
-        delBills = iqe.getDeletedBills()
-        for bill in delBills:
-            derashBill = self.getBillDerash(bill)
-            if len(derashBill) != 0:
-                updateBill = {
-                    "bill_id": derashBill["bill_id"],
-                    "bill_desc": "Bill no longer payable",
-                    "reason": "Paid or deleted",
-                    "amount_due": derashBill["amount_due"],
-                    "already_paid": True,
-                    "due_date": datetime.today().strftime("%Y-%m-%d")
-                }
-                self.conn.request('PUT', '/biller/customer-bill-data', headers=self.headers, body=json.dumps(updateBill))
+        workers = min(workers or self.workers, self.workers)
+        progress = self.tombstoneProgress()
+        bills = iqe.iterDeletedBills(progress["mark"])
+        results = self.runConcurrent(self.invalidateOne, bills, workers)
+        try:
+            for result in results:
+                self.tallyTombstone(progress, result, batchSize)
+            progress["exhausted"] = True
+        finally:
+            results.close()
+            bills.close()
+            self.finishTombstones(progress)
 
+        return progress["summary"].get("invalidated", 0)
 
 
-    def downloadPayment(self, iqe):
+    def invalidateOne(self, bill):
+        """
+        Mark's a deleted bill as no longer payable on Derash, if Derash has it and it isn't
+        already. Only the Derash bill uploaded under the deleted bill's own id is looked up,
+        and it's left alone (reused) while the customer still has unpaid bills in WSIS that
+        are known by it; the next upload that sees the customer updates it to those bills.
+        The PUT's response is checked, a bill Derash refused counts as failed.
+
+        :param bill: a deleted bill from iterDeletedBills, liveBillID being the customer's first
+            bill still unpaid in WSIS (None if there is none)
+        :return: a dictionary with billID, tombstone (the bill id as a number), action
+            (invalidated, missing, settled, reused or failed), the HTTP status and an error
+            message if any
+        """
+        result = {"billID": bill.billID, "tombstone": int(bill.billID), "action": "failed", "status": None,
+                  "error": None}
+        try:
+            derashBill = self.getBillDerash(bill, exact=True)
+            if len(derashBill) == 0:
+                result["action"] = "missing"
+                return result
+            if derashBill.get("already_paid"):
+                result["action"] = "settled"
+                return result
+            if (bill.liveBillID is not None and self.syncState is not None and
+                    self.syncState.findDerashID(self.town, [bill.liveBillID]) == derashBill["bill_id"]):
+                result["action"] = "reused"
+                return result
+
+            updateBill = {
+                "bill_id": derashBill["bill_id"],
+                "bill_desc": "Bill no longer payable",
+                "reason": "Paid or deleted",
+                "amount_due": derashBill["amount_due"],
+                "already_paid": True,
+                "due_date": datetime.today().strftime("%Y-%m-%d")
+            }
+            result["status"], _ = self.request('PUT', '/biller/customer-bill-data', updateBill)
+            if result["status"] < 300:
+                result["action"] = "invalidated"
+            else:
+                result["error"] = f"Derash responded with {result['status']}"
+        except Exception as e:
+            result["error"] = str(e)
+
+        return result
+
+
+    def tombstoneProgress(self):
+        """
+        Start's an invalidation pass from the tombstone watermark. Every sweepInterval seconds
+        the pass starts sweepWindow bill ids below it instead, picking up bills deleted after
+        bills with higher ids were; tombstones already handled then cost a lookup but no PUT,
+        and only the window's worth of them however long the deletion history grows.
+
+        :return: the progress dictionary taken by tallyTombstone and finishTombstones
+        """
+        mark = 0
+        sweep = True
+        if self.syncState is not None:
+            mark = int(self.syncState.getCursor(self.town + 'tombstones') or 0)
+            lastSweep = float(self.syncState.getCursor(self.town + 'tombstoneSweep') or 0)
+            sweep = mark == 0 or (self.sweepInterval > 0 and time.time() - lastSweep >= self.sweepInterval)
+
+        start = mark
+        if sweep:
+            start = max(0, mark - self.sweepWindow) if self.sweepWindow > 0 else 0
+        return {"mark": start, "committed": mark, "sweep": sweep, "blocked": False,
+                "exhausted": False, "handled": 0, "summary": {}}
+
+
+    def tallyTombstone(self, progress, result, batchSize=500):
+        """
+        Count's an invalidation result, in tombstone order. The watermark follows the bills
+        handled until the first failure, from there on the rest of the pass is tried but
+        left above the watermark so the next run tries again.
+
+        :param progress: from tombstoneProgress
+        :param result: a result from invalidateOne
+        :param batchSize: tombstones between watermark commits
+        """
+        summary = progress["summary"]
+        summary[result["action"]] = summary.get(result["action"], 0) + 1
+        if result["action"] == "failed":
+            print(f"Derash invalidation failed for bill {result['billID']}: {result['error']}")
+            progress["blocked"] = True
+        elif not progress["blocked"]:
+            progress["mark"] = max(progress["mark"], result["tombstone"])
+
+        progress["handled"] += 1
+        if progress["handled"] % batchSize == 0:
+            self.commitTombstones(progress)
+
+
+    def commitTombstones(self, progress):
+        """
+        Persist's the tombstone watermark, it never moves back (a sweep starts below it)
+        """
+        if self.syncState is not None and progress["mark"] > progress["committed"]:
+            self.syncState.setCursor(self.town + 'tombstones', progress["mark"])
+            progress["committed"] = progress["mark"]
+
+
+    def finishTombstones(self, progress):
+        """
+        Wrap's up an invalidation pass, a sweep that got through every tombstone is recorded
+        """
+        self.commitTombstones(progress)
+        if self.syncState is not None and progress["sweep"] and progress["exhausted"] and not progress["blocked"]:
+            self.syncState.setCursor(self.town + 'tombstoneSweep', time.time())
+        if progress["handled"] > 0:
+            print(f"Derash invalidation done: {progress['summary']}")
+
+
+    def paymentWindows(self, iqe):
         """
-        Download's all payments since the last unpaid bill from INSA Derash
+        Split's the range of dates to download payments for into windows of windowDays. The
+        range starts at the persisted payment cursor (the last day fully ingested, it's
+        fetched again to catch late records) or at the minimum unpaid bill date the first
+        time, and ends today. A normal poll is a single window, a backlog becomes many.
 
         :param iqe: object of db access
+        :return: a list of (fromDate, toDate) tuples of date objects
+        """
+        today = datetime.today().date()
+        cursor = None if self.syncState is None else self.syncState.getCursor(self.town + 'payments')
+        start = cursor if cursor is not None else iqe.getMinUnpaidDate()
+        fromDate = today if start is None else datetime.strptime(str(start)[:10], "%Y-%m-%d").date()
+
+        if (today - fromDate).days <= self.windowDays:
+            return [(fromDate, today)]
+
+        windows = []
+        while fromDate <= today:
+            toDate = min(fromDate + timedelta(days=self.windowDays - 1), today)
+            windows.append((fromDate, toDate))
+            fromDate = toDate + timedelta(days=1)
+        return windows
+
+
+    def downloadWindow(self, fromDate, toDate):
+        """
+        Download's the payments made in Derash between two dates (inclusive). The CSV body is
+        parsed as it arrives and yielded as Payment records (see payment_reader). A gzip or
+        deflate body is inflated chunk by chunk on the way.
+
+        :param fromDate: first day of the window
+        :param toDate: last day of the window
+        """
+        url = f"/biller/customers-paid-bill?fromDate={fromDate:%Y-%m-%d}&toDate={toDate:%Y-%m-%d}"
+        with self.pool.streaming('GET', url, headers=self.headers) as res:
+            if res.status != 200:
+                res.read()      # drain so the connection can be reused
+                raise http.client.HTTPException(f"payment download for {fromDate} - {toDate} failed with status {res.status}")
+
+            yield from readPayments(responseStream(res), self.town)
+
+
+    def downloadWindows(self, windows):
+        """
+        Download's several payment windows in parallel (one per worker) and yield's each
+        window along with its list of payments, in the order of the windows. A single window
+        is not buffered, its payments are streamed as they arrive.
+
+        :param windows: a list of (fromDate, toDate) from paymentWindows
+        :return: (fromDate, toDate), payments tuples
+        """
+        if len(windows) == 1:
+            yield windows[0], self.downloadWindow(*windows[0])
+            return
+
+        fetch = lambda window: (window, list(self.downloadWindow(*window)))
+        yield from self.runConcurrent(fetch, windows, min(self.workers, len(windows)))
+
+
+    def commitPaymentCursor(self, toDate):
         """
-        fromDate = iqe.getMinUnpaidDate()
-        toDate = datetime.today().strftime("%Y-%m-%d")
+        Move's the payment cursor once every payment up to toDate has been posted, the next
+        download starts there. Today is never complete, so the cursor stops at yesterday.
 
-        self.conn.request('GET', f"/biller/customers-paid-bill?fromDate={fromDate}&toDate={toDate}", headers=self.headers)
-        res = self.conn.getresponse()
-        result = res.read().decode('utf-8')
+        :param toDate: the last day of a fully ingested window
+        """
+        if self.syncState is None:
+            return
 
-        if res.status == 200:
-            return result # this is csv format
-        else:
-            return {}
\ No newline at end of file
+        yesterday = datetime.today().date() - timedelta(days=1)
+        self.syncState.setCursor(self.town + 'payments', min(toDate, yesterday))
+
+
+    def downloadPayment(self, iqe):
+        """
+        Download's all payments since the payment cursor (or the last unpaid bill) from INSA
+        Derash as a single stream of Payment records, so payments can be posted before the
+        download is over. It does not move the cursor, see commitPaymentCursor.
+
+        :param iqe: object of db access
+        """
+        for fromDate, toDate in self.paymentWindows(iqe):
+            yield from self.downloadWindow(fromDate, toDate)
\ No newline at end of file
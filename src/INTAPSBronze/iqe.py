@@ -6,6 +6,23 @@
 # Date Created: 21st of Septemeber 2024, Saturday
 import pyodbc
 import json
+import time
+from collections import namedtuple
+
+from metrics import registry
+from statements import compileScripts
+
+
+rowTypes = {}       # Bill record types by their column names, shared by all iQE objects
+
+# seconds each slow changing lookup is cached for, periodCheck is how often the currentPeriod
+# parameter is read to notice a new bill period before the others expire
+CACHE_TTL = {
+    "currentPeriod": 3600,
+    "dueDate": 3600,
+    "minUnpaidDate": 300,
+    "periodCheck": 60,
+}
 
 
 class iQE:
@@ -13,14 +30,40 @@ class iQE:
     iNTAPS Query Engine is a mimimal database accessor class using
     pyodbc library to communicate with the database server
     """
-    def __init__(self, connectionString):
+    def __init__(self, connectionString, incremental=False, fullScanInterval=3600, batchSize=500, cacheTTL=None,
+                 writeBatchSize=5000):
         """
         constructor
+
+        :param connectionString: the odbc connection string
+        :param incremental: True to have getUnpaidBills return only bills changed since the last pass
+        :param fullScanInterval: seconds between full rescans of unpaid bills in incremental mode
+        :param batchSize: number of rows fetched from the server at a time by the streaming methods
+        :param cacheTTL: dictionary overriding the seconds in CACHE_TTL, 0 turns caching of a lookup off
+        :param writeBatchSize: number of status rows bulk loaded and merged at a time by the write-back methods
         """
         self.connStr = connectionString
         self.conn = None
         self.qweries = {}
+        self.statements = {}            # compiled scripts by name, see loadScripts
         self.connected = False
+        self.batchSize = batchSize
+
+        self.incremental = incremental
+        self.fullScanInterval = fullScanInterval
+        self.watermark = None           # (billMark, paymentMark, itemMark) of the last completed pass
+        self.pendingWatermark = None    # watermark read at the start of the current pass
+        self.pendingFullScan = False
+        self.lastFullScan = 0
+
+        self.cacheTTL = dict(CACHE_TTL)
+        self.cacheTTL.update(cacheTTL or {})
+        self.cache = {}                 # (lookup, args) -> (value, expiry time)
+        self.cacheStats = {}            # lookup -> [hits, misses]
+        self.periodID = None            # currentPeriod parameter the cache was filled under
+
+        self.writeBatchSize = max(1, int(writeBatchSize))
+        self.statusTablesReady = False  # Bronze's status tables were checked/created
 
 
     def connect(self):
@@ -42,88 +85,307 @@ class iQE:
 
     def loadScripts(self):
         """
-        Load's the external SQL scripts or T-SQL statments from file 
+        Load's the external SQL scripts or T-SQL statments from file and compiles them once
+        into statements with typed parameters (see statements.compileScripts)
         """
         with open('scripts.json', 'r') as file:
             self.qweries = json.load(file)
+        self.statements = compileScripts(self.qweries)
+
+
+    def execute(self, cur, name, *args):
+        """
+        Execute's a compiled statement on a cursor, the arguments are bound to its `?`
+        parameters rather than spliced into the SQL so the server can reuse the plan
+
+        :param cur: the cursor to execute on
+        :param name: the statement name in scripts.json
+        :param args: the statement's parameter values in order
+        :return: the cursor
+        """
+        statement = self.statements[name]
+        return cur.execute(statement.sql, *statement.bind(args))
+
+
+    def statementStats(self):
+        """
+        :return: a dictionary of statement name to its execution stats, for statements run so far
+        """
+        return {name: statement.stats() for name, statement in self.statements.items() if statement.calls}
+
+
+    def rowType(self, columns):
+        """
+        Get's the compact record type for a result set, a namedtuple called Bill with one
+        field per column. Types are created once per distinct set of columns.
+
+        :param columns: the column names from cursor description
+        :return: the namedtuple class
+        """
+        columns = tuple(columns)
+        if columns not in rowTypes:
+            rowTypes[columns] = namedtuple('Bill', columns)
+        return rowTypes[columns]
+
+
+    def record(self, query, start, rows):
+        """
+        Add's a query run to the latency and row metrics
+
+        :param query: the script name in scripts.json
+        :param start: time.perf_counter() from before the query was executed
+        :param rows: number of rows fetched
+        """
+        seconds = time.perf_counter() - start
+        self.statements[query].record(seconds, rows)
+        registry.observe("bronze_iqe_query_seconds", seconds, query=query)
+        registry.inc("bronze_iqe_rows_total", rows, query=query)
 
 
-    def getUnpaidBills(self):
+    def streamRows(self, cur, query=None, start=None):
         """
-        Get's all unpaid bills that exist in WSIS database regardless of time
+        Yield's the rows of an executed cursor as Bill records, fetching batchSize rows at
+        a time so only one batch is held in memory. The cursor is closed once exhausted.
 
+        :param cur: a cursor that has executed a query
+        :param query: the script name, when given the run is added to the metrics once the cursor is closed
+        :param start: time.perf_counter() from before the query was executed
+        """
+        fetched = 0
+        try:
+            Bill = self.rowType(column[0] for column in cur.description)
+            while True:
+                rows = cur.fetchmany(self.batchSize)
+                if not rows:
+                    break
+                fetched += len(rows)
+                for row in rows:
+                    yield Bill._make(row)
+        finally:
+            cur.close()
+            if query is not None:
+                self.record(query, start, fetched)
+
+
+    def iterUnpaidBills(self, incremental=None):
+        """
+        Streaming version of getUnpaidBills; yield's unpaid bills as Bill records as they
+        arrive from the server. In incremental mode only customers that got a new bill, a
+        changed bill item or a settlement since the last committed watermark are returned
+        (see commitWatermark), with a full rescan every fullScanInterval seconds.
+
+        :param incremental: overrides the mode set at construction
+        """
+        if self.connected == False:
+            return
+        
+        if incremental is None:
+            incremental = self.incremental
+
+        # read the watermark before the bills so nothing written in between is missed
+        self.pendingWatermark = self.getBillWatermark()
+        self.pendingFullScan = (not incremental or self.watermark is None or
+                                time.monotonic() - self.lastFullScan >= self.fullScanInterval)
+
+        start = time.perf_counter()
+        cur = self.conn.cursor()
+        if self.pendingFullScan:
+            query = "qryUnpaidBills"
+            self.execute(cur, query)
+        else:
+            query = "qryUnpaidBillsChanged"
+            self.execute(cur, query, *self.watermark)
+
+        yield from self.streamRows(cur, query, start)
+
+
+    def getUnpaidBills(self, incremental=None):
+        """
+        Get's all unpaid bills that exist in WSIS database regardless of time, see
+        iterUnpaidBills for incremental mode
+
+        :param incremental: overrides the mode set at construction
         :return bill: a list of all unpaid bills that are in WSIS Subscriber Database
         """
         if self.connected == False:
             return -1
         
-        bills = []
+        return list(self.iterUnpaidBills(incremental))
+    
+
+    def getBillWatermark(self):
+        """
+        Read's the current high-watermark of bills; the maximum bill id, payment document id
+        and bill item id. Anything created, settled or corrected afterwards is above it.
+
+        :return: a tuple of (billMark, paymentMark, itemMark)
+        """
+        start = time.perf_counter()
         cur = self.conn.cursor()
-        cur.execute(' '.join(self.qweries["qwery"]["qryUnpaidBills"]))
-        columns = [column[0] for column in cur.description]
+        self.execute(cur, "qryBillWatermark")
+        row = cur.fetchone()
 
+        cur.close()
+        self.record("qryBillWatermark", start, 1)
+        return tuple(row)
+
+
+    def commitWatermark(self):
+        """
+        Marks the bills returned by the last getUnpaidBills as done, the next incremental pass
+        only returns what changed after it. Callers should not commit if some bills failed so
+        they are picked up again.
+        """
+        if self.pendingWatermark is None:
+            return
+
+        self.watermark = self.pendingWatermark
+        if self.pendingFullScan:
+            self.lastFullScan = time.monotonic()
+        self.pendingWatermark = None
+
+
+    def cached(self, lookup, load, *args):
+        """
+        Return's the result of a slow changing lookup from the cache, or runs load and caches
+        its result for the lookup's TTL
+
+        :param lookup: the name of the lookup in CACHE_TTL
+        :param load: a callable running the query, called with args
+        :param args: the lookup's arguments, part of the cache key
+        """
+        key = (lookup, args)
+        stats = self.cacheStats.setdefault(lookup, [0, 0])
+        entry = self.cache.get(key)
+        if entry is not None and time.monotonic() < entry[1]:
+            stats[0] += 1
+            registry.inc("bronze_iqe_cache_total", lookup=lookup, result="hit")
+            return entry[0]
+
+        stats[1] += 1
+        registry.inc("bronze_iqe_cache_total", lookup=lookup, result="miss")
+        value = load(*args)
+        ttl = self.cacheTTL.get(lookup, 0)
+        if ttl > 0:
+            self.cache[key] = (value, time.monotonic() + ttl)
+        return value
+
+
+    def invalidateCache(self, lookup=None):
+        """
+        Drop's cached results so the next call queries the database
+
+        :param lookup: the lookup to drop, None for all of them
+        """
+        if lookup is None:
+            self.cache = {}
+        else:
+            self.cache = {key: entry for key, entry in self.cache.items() if key[0] != lookup}
+
+
+    def checkPeriod(self):
+        """
+        Read's the currentPeriod parameter (cached for the periodCheck TTL) and drops the
+        cached period and due date as soon as it changes, i.e. when a new bill period opens
+        """
+        periodID = self.cached("periodCheck", self.queryPeriodID)
+        if periodID != self.periodID:
+            if self.periodID is not None:
+                print(f"Bronze: bill period changed from {self.periodID} to {periodID}.")
+            self.invalidateCache("currentPeriod")
+            self.invalidateCache("dueDate")
+            self.periodID = periodID
+
+
+    def queryPeriodID(self):
+        """
+        :return: the id of the current bill period from SystemParameter
+        """
+        start = time.perf_counter()
+        cur = self.conn.cursor()
+        self.execute(cur, "qryCurrentPeriodID")
         rows = cur.fetchall()
-        for row in rows:
-            bills.append(dict(zip(columns,row)))
-        
+
         cur.close()
-        return bills
-    
+        self.record("qryCurrentPeriodID", start, len(rows))
+        return rows[0][0]
+
 
     def getCurrentPeriod(self):
         """
         The current bill period is stored in SysParameters of Subscriber's database, 
         the function read's and return's the current bill period as human readable string
-        and not by its id, Bronze has no use of period IDs.
+        and not by its id, Bronze has no use of period IDs. The result is cached until the
+        period changes or its TTL runs out.
 
         :return: the current bill period as human readable string
         """
         if self.connected == False:
             return -1
         
+        self.checkPeriod()
+        return self.cached("currentPeriod", self.queryCurrentPeriod)
+
+
+    def queryCurrentPeriod(self):
+        start = time.perf_counter()
         cur = self.conn.cursor()
-        cur.execute(' '.join(self.qweries["qwery"]["qryCurrentPeriod"]))
+        self.execute(cur, "qryCurrentPeriod")
         rows = cur.fetchall()
 
         cur.close()
+        self.record("qryCurrentPeriod", start, len(rows))
         return rows[0][0]
     
 
-    def getDeletedBills(self):
+    def iterDeletedBills(self, mark=0):
+        """
+        Streaming version of getDeletedBills, yield's deleted bills as Bill records in bill
+        id order, each with liveBillID, the customer's first bill still unpaid (None if none)
+
+        :param mark: the tombstone watermark, only bills deleted with an id above it are returned
+        """
+        if self.connected == False:
+            return
+        
+        start = time.perf_counter()
+        cur = self.conn.cursor()
+        self.execute(cur, "qryUnpaidBillsDeleted", mark)
+        yield from self.streamRows(cur, "qryUnpaidBillsDeleted", start)
+
+
+    def getDeletedBills(self, mark=0):
         """
         Return's all the deleted bills from WSIS database, this is used to invalidate
         existing bills
 
+        :param mark: the tombstone watermark, only bills deleted with an id above it are returned
         :return deleted: bills list on success alas -1 on fail
         """
         if self.connected == False:
             return -1
         
-        cur = self.conn.cursor()
-        cur.execute(' '.join(self.qweries["qwery"]["qryCurrentPeriod"]))
-        columns = [column[0] for column in cur.description]
-
-        rows = cur.fetchall()
-        deleted = []
-        for row in rows:
-            deleted.append(dict(zip(columns, row)))
-
-        cur.close()
-        return deleted
+        return list(self.iterDeletedBills(mark))
     
 
     def getMinUnpaidDate(self):
         """
-        :return date: get's the minimum of date for the unpaid bills
+        :return date: get's the minimum of date for the unpaid bills, cached for its TTL
         """
         if self.connected == False:
             return -1
         
+        return self.cached("minUnpaidDate", self.queryMinUnpaidDate)
+
+
+    def queryMinUnpaidDate(self):
+        start = time.perf_counter()
         cur = self.conn.cursor()
-        cur.execute(' '.join(self.qweries["qwery"]["qryMinUnpaidBillDate"]))
+        self.execute(cur, "qryMinUnpaidBillDate")
 
         rows = cur.fetchall()
         cur.close()
+        self.record("qryMinUnpaidBillDate", start, len(rows))
         return rows[0][0]
     
 
@@ -138,33 +400,152 @@ class iQE:
         if self.connected == False:
             return
         
+        start = time.perf_counter()
         cur = self.conn.cursor()
-        qwery = ' '.join(self.qweries["qwery"]["qrySettledBills"])
-        cur.execute(qwery.replace("@bid", str(billID)))
-        #print(qwery.replace("@bid", str(billID)))
+        self.execute(cur, "qrySettledBills", str(billID).strip('"'))
         rows = cur.fetchall()
         for row in rows:
             ids.append(row[0])
 
         cur.close()
+        self.record("qrySettledBills", start, len(rows))
         return ids
     
 
-    def getDueDate(self, pid):
+    def getSettledBillsBatch(self, billIDs):
+        """
+        Batch version of getSettledBills, resolves the unpaid bill ID's for every bill in
+        a payment download at once. The ids are bulk loaded into a temp table and joined
+        in a single query rather than running qrySettledBills once per bill.
+
+        :param billIDs: the bill ids (int or numeric strings) from the payments
+        :return: a dictionary mapping each bill id (as int) to its list of unpaid bill ids
+        """
+        if self.connected == False:
+            return
+
+        ids = set()
+        for billID in billIDs:
+            try:
+                ids.add(int(str(billID).strip('"')))
+            except ValueError:
+                continue    # not a WSIS bill id, nothing to settle
+
+        settled = {billID: [] for billID in ids}
+        if len(ids) == 0:
+            return settled
+
+        start = time.perf_counter()
+        cur = self.conn.cursor()
+        self.execute(cur, "qryCreateBillIDsTemp")
+        insert = self.statements["qryInsertBillIDsTemp"]
+        cur.fast_executemany = True
+        cur.executemany(insert.sql, [insert.bind((billID,)) for billID in ids])
+
+        self.execute(cur, "qrySettledBillsBatch")
+        rows = cur.fetchall()
+        for row in rows:
+            settled[row[0]].append(row[1])
+
+        self.execute(cur, "qryDropBillIDsTemp")
+        cur.close()
+        self.record("qrySettledBillsBatch", start, len(rows))
+        return settled
+    
+
+    def getDueDate(self, pid=None):
         """ Given its period ID returns the last date for payment or due date from
         it's 'toDate' feild. The previous day from this feild is the due date or last
         payment date allowed before the next bill period opens and upload's it's bills
         
-        :param pid: the period id for current period
+        :param pid: the period id, None for the current period
         """
         if self.connected == False:
             return
         
-        cursor = self.conn.cursor()
+        self.checkPeriod()
+        if pid is None:
+            pid = self.periodID
+        return self.cached("dueDate", self.queryDueDate, pid)
 
-        qwery = ' '.join(self.qweries["qwery"]["qrySettledBills"])
-        cursor.execute(qwery.replace("@pid", str(pid)))
+
+    def queryDueDate(self, pid):
+        start = time.perf_counter()
+        cursor = self.conn.cursor()
+        self.execute(cursor, "qryGetDueDate", pid)
 
         rows = cursor.fetchall()
         cursor.close()
-        return rows[0][0]
\ No newline at end of file
+        self.record("qryGetDueDate", start, len(rows))
+        return rows[0][0]
+
+
+    def writeBillStatus(self, rows):
+        """
+        Record's the Derash sync status of bills in Bronze's BronzeBillStatus table so operators
+        can see what was pushed to Derash without reconciling by hand. A row is keyed by the
+        customer's first bill id, the whole aggregated list (unbounded in length) kept beside it.
+
+        :param rows: (town, billID, bills, derashID, action, amount, httpStatus, error) tuples
+        :return: the number of rows written
+        """
+        return self.mergeStatus("BillStatus", rows, lambda row: (row[0], row[1]))
+
+
+    def writePaymentStatus(self, rows):
+        """
+        Record's the WSIS posting status of Derash payments in Bronze's BronzePaymentStatus table
+
+        :param rows: (confirmationCode, town, billID, amount, agent, state, error) tuples
+        :return: the number of rows written
+        """
+        return self.mergeStatus("PaymentStatus", rows, lambda row: row[0])
+
+
+    def mergeStatus(self, kind, rows, key):
+        """
+        Bulk write's status rows; each batch of writeBatchSize rows is loaded into a temp table
+        with fast_executemany (one round trip for the whole batch) and merged into the status
+        table with a single MERGE, rather than an INSERT or UPDATE per row. The status tables
+        are created on first use.
+
+        :param kind: BillStatus or PaymentStatus, picks the qryCreate/Insert/Merge/Drop scripts
+        :param rows: the rows in the column order of the insert script
+        :param key: returns the primary key of a row, a later row replaces an earlier one
+        :return: the number of rows written
+        """
+        if self.connected == False:
+            return 0
+
+        # MERGE refuses two source rows for the same target row
+        rows = list({key(row): row for row in rows}.values())
+        if len(rows) == 0:
+            return 0
+
+        if not self.statusTablesReady:
+            cur = self.conn.cursor()
+            self.execute(cur, "qryCreateStatusTables")
+            self.conn.commit()
+            cur.close()
+            self.statusTablesReady = True
+
+        insert = self.statements[f"qryInsert{kind}Temp"]
+        for first in range(0, len(rows), self.writeBatchSize):
+            batch = rows[first:first + self.writeBatchSize]
+            start = time.perf_counter()
+            cur = self.conn.cursor()
+            try:
+                self.execute(cur, f"qryCreate{kind}Temp")
+                cur.fast_executemany = True
+                cur.executemany(insert.sql, [insert.bind(row) for row in batch])
+                self.execute(cur, f"qryMerge{kind}")
+                self.execute(cur, f"qryDrop{kind}Temp")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            finally:
+                cur.close()
+            self.record(f"qryMerge{kind}", start, len(batch))
+
+        return len(rows)
@@ -3,79 +3,672 @@
 # Program Author: Rediet Worku aka Aethiops II ben Zahab
 #
 # Date Created: 21st of Septemeber 2024, Saturday
+import argparse
+import asyncio
 import http.client
 import json
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
+from async_runtime import AsyncScheduler, mapConcurrent, stream, take
 from derash_client import DerashClient
 from iqe import iQE
-from wsis_client import WSISClient
+from metrics import registry, MetricsServer
+from outbox import Outbox
+import payment_ledger
+from payment_ledger import PaymentLedger
+from profiler import Profiler
+from reconcile import Reconciler
+from scheduler import Scheduler, Stage
+from throttle import Throttle
+from sync_state import SyncState
+from wsis_client import WSISClient, RECEIPT_PATH
 
 
-SLEEP_TIME = 10
+# default stage intervals in seconds, overridden by the "Schedule" object in appsettings.json
+SCHEDULE = {
+    "upload": {"enabled": True, "interval": 300, "maxInterval": 1800, "batchLimit": 5000},
+    "invalidate": {"enabled": True, "interval": 600, "maxInterval": 3600, "batchLimit": None},
+    "payments": {"enabled": True, "interval": 10, "maxInterval": 60, "batchLimit": None},
+    "reconcile": {"enabled": False, "interval": 86400, "maxInterval": 86400, "batchLimit": None},
+}
 
-def Main():
+
+def syncPayments(derash_client, wsis, iqe, ledger, config):
+    """
+    Retries payments left unposted by earlier cycles, then downloads new payments from
+    Derash window by window and posts them to WSIS. The payment cursor moves after each
+    window so a failure resumes from the last window completed.
+
+    :return: the number of payments posted
+    """
+    statuses = []
+    onResult = paymentStatus(derash_client, config, statuses)
+    handled = wsis.postBillPayment(ledger.getRetryable(), iqe, config["CashAccount"], config["AssetID"],
+                                   onResult=onResult)
+    writeStatus(iqe.writePaymentStatus, statuses)
+
+    windows = derash_client.paymentWindows(iqe)
+    if len(windows) > 1:
+        print(f"Bronze: Catching up on {len(windows)} payment download windows.")
+
+    for (fromDate, toDate), payments in derash_client.downloadWindows(windows):
+        handled += wsis.postBillPayment(payments, iqe, config["CashAccount"], config["AssetID"], onResult=onResult)
+        derash_client.commitPaymentCursor(toDate)
+        writeStatus(iqe.writePaymentStatus, statuses)
+
+    finishPayments(handled, ledger, derash_client.town)
+    return handled
+
+
+async def syncPaymentsAsync(derash_client, wsis, iqe, db, ledger, config):
+    """
+    The asyncio version of syncPayments; the next batch of payments downloads while the one
+    before it posts to WSIS. Posting (which reads settlements from the database) runs on db,
+    the stage's database thread.
+
+    :param db: the single thread executor of iqe
+    :return: the number of payments posted
+    """
+    loop = asyncio.get_running_loop()
+    statuses = []
+    onResult = paymentStatus(derash_client, config, statuses)
+    post = lambda payments: wsis.postBillPayment(payments, iqe, config["CashAccount"], config["AssetID"],
+                                                 onResult=onResult)
+
+    handled = await loop.run_in_executor(db, post, ledger.getRetryable())
+    await loop.run_in_executor(db, writeStatus, iqe.writePaymentStatus, statuses)
+
+    windows = await loop.run_in_executor(db, derash_client.paymentWindows, iqe)
+    if len(windows) > 1:
+        print(f"Bronze: Catching up on {len(windows)} payment download windows.")
+
+    def batches():
+        # payment batches of a window followed by the window's last day
+        for (fromDate, toDate), payments in derash_client.downloadWindows(windows):
+            payments = iter(payments)
+            while batch := take(payments, 500):
+                yield batch
+            yield toDate
+
+    items = stream(batches())
+    try:
+        async for item in items:
+            if isinstance(item, date):
+                derash_client.commitPaymentCursor(item)
+                await loop.run_in_executor(db, writeStatus, iqe.writePaymentStatus, statuses)
+            else:
+                handled += await loop.run_in_executor(db, post, item)
+    finally:
+        await items.aclose()
+
+    finishPayments(handled, ledger, derash_client.town)
+    return handled
+
+
+def paymentStatus(derash_client, config, statuses):
+    """
+    :param statuses: the list to collect status rows in
+    :return: the onResult callback of postBillPayment, None when status write-back is off
+    """
+    if not config["Database"].get("statusWriteBack", False):
+        return None
+
+    return lambda payment, state, error: statuses.append(
+        (payment.confirmationCode, derash_client.town, payment.billID, payment.amount, payment.agent,
+         state, None if error is None else error[:400]))
+
+
+def finishPayments(handled, ledger, town):
+    """
+    Report's a payments cycle and updates the town's ledger gauges
+    """
+    if handled > 0:
+        print(f"Bronze: {town} Posted {handled} new payment bills from INSA Derash.")
+
+    for state in (payment_ledger.DOWNLOADED, payment_ledger.POSTING, payment_ledger.FAILED, payment_ledger.UNKNOWN):
+        registry.set("bronze_payments", ledger.count(state), state=state, town=town)
+    registry.set("bronze_payments", ledger.countGivenUp(), state="abandoned", town=town)
+
+
+def uploadBills(derash_client, iqe, limit, writeBack=False):
+    """
+    The upload stage; syncs unpaid bills with Derash
+
+    :param writeBack: True to record the status of every bill synced in the database
+    :return: the number of bills that needed a request to Derash
+    """
+    statuses = []
+    summary = derash_client.uploadDerash(iqe, limit=limit,
+                                         onResult=billStatus(derash_client, statuses) if writeBack else None)
+    writeStatus(iqe.writeBillStatus, statuses)
+    return sum(count for action, count in summary.items() if action != "skipped")
+
+
+async def uploadBillsAsync(derash_client, iqe, db, limit, writeBack=False):
+    """
+    The asyncio version of uploadBills; bills are prefetched from the database while the
+    ones before them sync on the client's workers
+
+    :param db: the single thread executor of iqe
+    :return: the number of bills that needed a request to Derash
+    """
+    loop = asyncio.get_running_loop()
+    period = await loop.run_in_executor(db, iqe.getCurrentPeriod)
+    dueDate = await loop.run_in_executor(db, iqe.getDueDate)
+    print(f"Uploading bills to Derash API using {derash_client.workers} worker(s).")
+
+    statuses = []
+    onResult = billStatus(derash_client, statuses) if writeBack else None
+    summary = {}
+    synced = 0
+    exhausted = True
+    sync = lambda bill: derash_client.syncBill(bill, period, dueDate)
+    results = mapConcurrent(stream(iqe.iterUnpaidBills(), iqe.batchSize, reader=db), sync,
+                            derash_client.executor, derash_client.workers)
+    try:
+        async for result in results:
+            if derash_client.tally(summary, result, onResult):
+                synced += 1
+                if limit is not None and synced >= limit:
+                    exhausted = False
+                    break
+    finally:
+        await results.aclose()
+
+    await loop.run_in_executor(db, derash_client.finishUpload, iqe, summary, exhausted)
+    await loop.run_in_executor(db, writeStatus, iqe.writeBillStatus, statuses)
+    return sum(count for action, count in summary.items() if action != "skipped")
+
+
+def billStatus(derash_client, statuses):
+    """
+    :param statuses: the list to collect status rows in
+    :return: the onResult callback of uploadDerash
+    """
+    def onResult(result):
+        if result["action"] == "failed":
+            print(f"Derash upload failed for bill {result['billID']}: {result['error']}")
+        if result["action"] != "skipped":
+            bills = str(result["billID"])
+            statuses.append((derash_client.town, bills.split(',')[0], bills, result["derashID"], result["action"],
+                             result["amount"], result["status"],
+                             None if result["error"] is None else result["error"][:400]))
+    return onResult
+
+
+async def invalidateBillsAsync(derash_client, iqe, db, batchSize=500):
+    """
+    The asyncio version of DerashClient.invalidateBill, tombstones above the watermark are
+    prefetched from the database while the ones before them are invalidated on the client's
+    workers
+
+    :param db: the single thread executor of iqe
+    :return: the number of bills invalidated
+    """
+    progress = derash_client.tombstoneProgress()
+    results = mapConcurrent(stream(iqe.iterDeletedBills(progress["mark"]), iqe.batchSize, reader=db),
+                            derash_client.invalidateOne, derash_client.executor, derash_client.workers)
+    try:
+        async for result in results:
+            derash_client.tallyTombstone(progress, result, batchSize)
+        progress["exhausted"] = True
+    finally:
+        await results.aclose()
+        derash_client.finishTombstones(progress)
+
+    return progress["summary"].get("invalidated", 0)
+
+
+def reconcileBills(reconciler, iqe, repair):
+    """
+    The reconcile stage; checks the unpaid bills in WSIS against the sync state
+
+    :return: the number of bills that differed
+    """
+    report = reconciler.run(iqe, repair)
+    return len(report["missing"]) + len(report["stale"]) + len(report["orphaned"])
+
+
+def writeStatus(write, rows):
+    """
+    Write's a cycle's status rows back to the database once the stage is done with Derash and
+    WSIS; a failure is reported but does not fail the stage, the sync itself went through
+
+    :param write: iQE.writeBillStatus or iQE.writePaymentStatus
+    :param rows: the status rows, emptied once written
+    """
+    if len(rows) == 0:
+        return
+
+    try:
+        write(rows)
+    except Exception as e:
+        print(f"Bronze: status write-back of {len(rows)} rows failed: {e}")
+    rows.clear()
+
+
+def stageSettings(config, name):
+    """
+    :return: the schedule of a stage, the defaults in SCHEDULE updated from appsettings.json
+    """
+    settings = dict(SCHEDULE[name])
+    settings.update(config.get("Schedule", {}).get(name, {}))
+    return settings
+
+
+def newIQE(config):
+    """
+    Connect's a database engine, each stage gets one of its own since a pyodbc connection
+    must not be used by two threads at once
+    """
+    iqe = iQE(config["Database"]["connectionString"],
+              incremental=config["Database"].get("incremental", False),
+              fullScanInterval=config["Database"].get("fullScanInterval", 3600),
+              batchSize=config["Database"].get("batchSize", 500),
+              cacheTTL=config["Database"].get("cacheTTL"),
+              writeBatchSize=config["Database"].get("writeBatchSize", 5000))
+    iqe.connect()
+    iqe.loadScripts()
+    return iqe
+
+
+def newDerashClient(config, syncState, outbox=None, throttle=None):
+    """
+    Connect's a Derash client, each stage gets one of its own so a long upload does not
+    hold all the pooled connections; they share the town's throttle
+    """
+    domain = config["Derash"]["domain"]
+    apiKey = config["Derash"]["apiKey"]
+    apiSecret = config["Derash"]["apiSecret"]
+    workers = config["Derash"].get("workers", 1)
+    windowDays = config["Derash"].get("windowDays", 1)
+    utilityTown = str(config["Town"]).upper() + '-'
+    negativeTTL = config["Derash"].get("negativeTTL", 3600)
+    sweepInterval = config["Derash"].get("tombstoneSweepInterval", 86400)
+    sweepWindow = config["Derash"].get("tombstoneSweepWindow", 100000)
+    timeout = config["Derash"].get("timeout", 30)
+    derash_client = DerashClient(domain, apiKey, apiSecret, utilityTown, workers=workers, syncState=syncState,
+                                 windowDays=windowDays, negativeTTL=negativeTTL, outbox=outbox,
+                                 sweepInterval=sweepInterval, throttle=throttle, sweepWindow=sweepWindow,
+                                 timeout=timeout)
+    derash_client.connect()
+    return derash_client
+
+
+def newThrottle(config):
+    """
+    :return: the Throttle of a town's Derash requests as set by "throttle" under "Derash", None if
+        it's not set or not enabled
+    """
+    if config["Derash"].get("throttle") is None:
+        return None
+    settings = dict(config["Derash"]["throttle"])
+    if not settings.pop("enabled", True):
+        return None
+    return Throttle(str(config["Town"]).upper() + '-', **settings)
+
+
+def newProfiler(config):
+    """
+    :return: the Profiler of the stages named under "Profile", None if it's not enabled or no
+        stage is named; shared by every town since tracemalloc traces the whole process
+    """
+    settings = dict(config.get("Profile") or {})
+    stages = settings.pop("stages", [])
+    if not settings.pop("enabled", False) or not stages:
+        return None
+    return Profiler(stages, **settings)
+
+
+def townConfigs(config):
+    """
+    Split's appsettings.json into one config per town. Without a "Towns" list the file itself
+    is the only town. Otherwise each entry of "Towns" is laid over the top-level settings,
+    which serve as defaults shared by every town; objects (i.e. "Derash") are merged key by
+    key. A town without a "SyncState" of its own gets a state file of its own.
+
+    :return: a list of config dictionaries, one per town
+    """
+    towns = config.get("Towns")
+    if not towns:
+        return [config]
+
+    configs = []
+    for town in towns:
+        merged = {key: value for key, value in config.items() if key != "Towns"}
+        for key, value in town.items():
+            if isinstance(value, dict) and isinstance(merged.get(key), dict):
+                merged[key] = {**merged[key], **value}
+            else:
+                merged[key] = value
+
+        if "SyncState" not in town:
+            merged["SyncState"] = f"bronze-{str(town['Town']).lower()}.db"
+        configs.append(merged)
+    return configs
+
+
+class TownWorker:
+    """
+    The sync loop of a single town; its own database connections, Derash and WSIS clients,
+    state files and a thread group of stages. Nothing is shared with other towns but the
+    metrics, so a town that fails or is throttled does not hold the others back.
+    """
+    def __init__(self, config, profiler=None):
+        """
+        :param config: the town's config, see townConfigs
+        :param profiler: a Profiler to wrap the town's stages with, None to not profile
+        """
+        self.config = config
+        self.profiler = profiler
+        self.town = str(config["Town"]).upper() + '-'
+        self.running = False
+        self.failures = 0               # consecutive failed starts
+        self.retryAt = 0.0              # time.monotonic() of the next start attempt
+        self.scheduler = None
+        self.syncState = None
+        self.ledger = None
+        self.wsis = None
+        self.outbox = None
+        self.throttle = None
+        self.iqes = []
+        self.executors = []             # database threads of the asyncio runtime, one per iQE
+        self.derash_clients = []
+
+
+    def start(self):
+        """
+        Connect's everything the town needs and starts its stages. Raises if the town can not
+        be started, whatever was opened is closed by stop.
+        """
+        config = self.config
+        print(f"Bronze: {self.town} Opening local sync state index.")
+        self.syncState = SyncState(config.get("SyncState", "bronze.db"))
+        self.syncState.open()
+        self.ledger = PaymentLedger(config.get("SyncState", "bronze.db"), config["WSIS"].get("retryAttempts", 5),
+                                    config["WSIS"].get("retryBackoff", 300), config["WSIS"].get("retryMaxBackoff", 21600))
+        self.ledger.open()
+
+        outbox = config.get("Outbox", {})
+        if outbox.get("enabled", True):
+            path = outbox.get("path", os.path.splitext(config.get("SyncState", "bronze.db"))[0] + '.outbox')
+            self.outbox = Outbox(path, fsync=outbox.get("fsync", False))
+            self.outbox.open()
+
+        self.throttle = newThrottle(config)
+
+        runtime = config.get("Runtime", "threads")
+        if runtime not in ("threads", "asyncio"):
+            raise ValueError(f"unknown Runtime {runtime}, use threads or asyncio")
+        concurrent = runtime == "asyncio"
+        self.scheduler = AsyncScheduler(self.town) if concurrent else Scheduler()
+        upload = stageSettings(config, "upload")
+        invalidate = stageSettings(config, "invalidate")
+        payments = stageSettings(config, "payments")
+        reconcile = stageSettings(config, "reconcile")
+
+        if upload["enabled"]:
+            print(f"Bronze: {self.town} Scheduling bill upload to INSA Derash API.")
+            self.iqes.append(newIQE(config))
+            self.derash_clients.append(newDerashClient(config, self.syncState, self.outbox, self.throttle))
+            writeBack = config["Database"].get("statusWriteBack", False)
+            if concurrent:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1], db=self.newExecutor(): \
+                    uploadBillsAsync(client, iqe, db, upload["batchLimit"], writeBack)
+            else:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1]: \
+                    uploadBills(client, iqe, upload["batchLimit"], writeBack)
+            self.scheduler.add(Stage("upload", func, upload["interval"], upload["maxInterval"], upload["batchLimit"],
+                                     self.town))
+
+        if invalidate["enabled"]:
+            print(f"Bronze: {self.town} Scheduling deleted bill invalidation on INSA Derash API.")
+            self.iqes.append(newIQE(config))
+            self.derash_clients.append(newDerashClient(config, self.syncState, self.outbox, self.throttle))
+            if concurrent:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1], db=self.newExecutor(): \
+                    invalidateBillsAsync(client, iqe, db)
+            else:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1]: client.invalidateBill(iqe)
+            self.scheduler.add(Stage("invalidate", func, invalidate["interval"], invalidate["maxInterval"],
+                                     invalidate["batchLimit"], self.town))
+
+        if reconcile["enabled"]:
+            print(f"Bronze: {self.town} Scheduling reconciliation of unpaid bills with the sync state.")
+            self.iqes.append(newIQE(config))
+            self.derash_clients.append(newDerashClient(config, self.syncState, self.outbox, self.throttle))
+            reconciler = Reconciler(self.syncState, self.town, config.get("Reconcile", {}).get("buckets", 1024),
+                                    self.derash_clients[-1])
+            repair = config.get("Reconcile", {}).get("repair", True)
+            if concurrent:
+                func = lambda iqe=self.iqes[-1], db=self.newExecutor(): \
+                    asyncio.get_running_loop().run_in_executor(db, reconcileBills, reconciler, iqe, repair)
+            else:
+                func = lambda iqe=self.iqes[-1]: reconcileBills(reconciler, iqe, repair)
+            self.scheduler.add(Stage("reconcile", func, reconcile["interval"], reconcile["maxInterval"],
+                                     reconcile["batchLimit"], self.town))
+
+        if payments["enabled"]:
+            print(f"Bronze: {self.town} Connecting to WSIS Server.")
+            host = config["WSIS"]["server"]
+            port = config["WSIS"]["port"]
+            uname = config["WSIS"]["username"]
+            pwd = config["WSIS"]["password"]
+            self.wsis = wsis = WSISClient(ledger=self.ledger,
+                                          receiptPath=config["WSIS"].get("receiptPath", RECEIPT_PATH),
+                                          workers=config["WSIS"].get("workers", 1),
+                                          sessionTTL=config["WSIS"].get("sessionTTL", 1800),
+                                          outbox=self.outbox,
+                                          timeout=config["WSIS"].get("timeout", 30))
+            wsis.connect(host, port)
+            if wsis.startSession(uname, pwd) == False:
+                raise http.client.HTTPException("WSIS session failed, please check username and password.")
+            wsis.getPaymentCenter()
+
+            print(f"Bronze: {self.town} Scheduling payment download from INSA Derash and posting to WSIS.")
+            self.iqes.append(newIQE(config))
+            self.derash_clients.append(newDerashClient(config, self.syncState, self.outbox, self.throttle))
+            if concurrent:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1], db=self.newExecutor(): \
+                    syncPaymentsAsync(client, wsis, iqe, db, self.ledger, config)
+            else:
+                func = lambda iqe=self.iqes[-1], client=self.derash_clients[-1]: \
+                    syncPayments(client, wsis, iqe, self.ledger, config)
+            self.scheduler.add(Stage("payments", func, payments["interval"], payments["maxInterval"],
+                                     payments["batchLimit"], self.town))
+
+        # finish what the last run left in flight before the stages start new work
+        if self.derash_clients:
+            self.derash_clients[0].replayOutbox()
+        if self.wsis is not None:
+            self.wsis.replayOutbox()
+
+        if self.profiler is not None:
+            for stage in self.scheduler.stages:
+                stage.func = self.profiler.wrap(self.town, stage.name, stage.func)
+
+        self.scheduler.start()
+        self.running = True
+
+
+    def newExecutor(self):
+        """
+        :return: a single thread executor for the asyncio runtime to run a stage's iQE calls on,
+            the rows the stage streams included (see async_runtime.stream), keeping its pyodbc
+            connection off the event loop and off every other thread
+        """
+        self.executors.append(ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bronze-{self.town}db"))
+        return self.executors[-1]
+
+
+    def stop(self):
+        """
+        Stop's the town's stages and closes everything it opened
+        """
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+        for iqe in self.iqes:
+            iqe.disconnect()
+
+        for derash_client in self.derash_clients:
+            derash_client.disconnect()
+
+        if self.wsis is not None:
+            self.wsis.disconnect()
+
+        if self.syncState is not None:
+            self.syncState.close()
+
+        if self.ledger is not None:
+            self.ledger.close()
+
+        if self.outbox is not None:
+            self.outbox.close()
+
+        self.scheduler = self.syncState = self.ledger = self.wsis = self.outbox = self.throttle = None
+        self.iqes = []
+        self.executors = []
+        self.derash_clients = []
+        self.running = False
+
+
+class Supervisor:
+    """
+    Run's the TownWorker of every configured town in the one process. A town that fails to
+    start (i.e. its database or WSIS is down) is retried with a growing delay while the
+    other towns carry on.
+    """
+    def __init__(self, configs, retryInterval=60, maxRetryInterval=900, profiler=None):
+        """
+        :param configs: a list of town configs, see townConfigs
+        :param retryInterval: seconds before a town that failed to start is tried again
+        :param maxRetryInterval: upper bound of the delay, it doubles with every failure
+        :param profiler: a Profiler shared by the towns' stages, None to not profile
+        """
+        self.workers = [TownWorker(config, profiler) for config in configs]
+        self.retryInterval = retryInterval
+        self.maxRetryInterval = maxRetryInterval
+        self.stopping = threading.Event()
+
+
+    def startTown(self, worker):
+        """
+        Start's a town, on failure its resources are released and the next attempt scheduled
+        """
+        try:
+            worker.start()
+            worker.failures = 0
+        except Exception as e:
+            worker.stop()
+            worker.failures += 1
+            delay = min(self.retryInterval * 2 ** (worker.failures - 1), self.maxRetryInterval)
+            worker.retryAt = time.monotonic() + delay
+            registry.inc("bronze_town_failures_total", town=worker.town)
+            print(f"Bronze: {worker.town} failed to start ({e}), retrying in {delay} seconds.")
+
+
+    def start(self):
+        for worker in self.workers:
+            self.startTown(worker)
+
+
+    def wait(self):
+        """
+        Block's until stopped (i.e. on Ctrl+C), retrying towns that failed to start
+        """
+        try:
+            while not self.stopping.wait(1):
+                for worker in self.workers:
+                    if not worker.running and time.monotonic() >= worker.retryAt:
+                        self.startTown(worker)
+        except KeyboardInterrupt:
+            print("Bronze: Stopping.")
+        self.stop()
+
+
+    def stop(self):
+        self.stopping.set()
+        for worker in self.workers:
+            worker.stop()
+
+
+def parseArgs(argv=None):
+    """
+    :param argv: the command line arguments, sys.argv's by default
+    :return: the parsed command line; the profiling switches override "Profile" in appsettings.json
+    """
+    parser = argparse.ArgumentParser(prog="bronze", description="Syncs WSIS bills and payments with INSA Derash.")
+    parser.add_argument("--profile", metavar="STAGE", action="append",
+                        help="profile a stage (upload, invalidate, payments, reconcile), a function (uploadDerash, "
+                             "downloadPayment, postBillPayment) or iqe for the database queries; repeatable")
+    parser.add_argument("--profile-every", metavar="N", type=int, help="profile one cycle in N")
+    parser.add_argument("--profile-dir", metavar="DIR", help="directory the profiles are written to")
+    parser.add_argument("--profile-keep", metavar="N", type=int, help="profiles kept per town and stage")
+    return parser.parse_args(argv)
+
+
+def profileSettings(config, args):
+    """
+    :return: "Profile" of appsettings.json with the command line's profiling switches laid over it
+    """
+    settings = dict(config.get("Profile") or {})
+    if args.profile:
+        settings["enabled"] = True
+        settings["stages"] = args.profile
+    for key, value in (("every", args.profile_every), ("directory", args.profile_dir), ("keep", args.profile_keep)):
+        if value is not None:
+            settings[key] = value
+    return settings
+
+
+def Main(argv=None):
     """
     The arena
     """
-    running = True
+    args = parseArgs(argv)
     try:
         print("Bronze: Initializing.")
         with open('appsettings.json', 'r') as file:
             config = json.load(file)
 
-        print("Bronze: Connecting to database.")
-        iqe = iQE(config["Database"]["connectionString"])
-        iqe.connect()
-        iqe.loadScripts()
-        
-        print('Bronze: Connecting to INSA Derash API.')
-        domain = config["Derash"]["domain"]
-        apiKey = config["Derash"]["apiKey"]
-        apiSecret = config["Derash"]["apiSecret"]
-        utilityTown = str(config["Town"]).upper() + '-'
-        derash_client = DerashClient(domain, apiKey, apiSecret, utilityTown)
-        derash_client.connect()
-
-        print("Bronze: Connecting to WSIS Server.")
-        host = config["WSIS"]["server"]
-        port = config["WSIS"]["port"]
-        uname = config["WSIS"]["username"]
-        pwd = config["WSIS"]["password"]
-        wsis = WSISClient()
-        wsis.connect(host, port)
-        if wsis.startSession(uname, pwd) == False:
-            print("Bronze: WSIS session failed, please check username and password.")
-            running = False
-        else:
-            wsis.getPaymentCenter()
-        
-        while running:
-            print('Bronze: Uploading bills to INSA Derash API.')
-            #derash_client.uploadDerash(iqe)
-
-            print("Bronze: Downloading payments from INSA Derash.")
-            payments = derash_client.downloadPayment(iqe)
-            print(f"Bronze: Found {len(payments)} payment bills from INSA Derash.")
+        if config.get("Metrics", {}).get("enabled", False):
+            host = config["Metrics"].get("host", "127.0.0.1")
+            port = config["Metrics"].get("port", 9464)
+            print(f"Bronze: Serving metrics on http://{host}:{port}/metrics")
+            metricsServer = MetricsServer(host, port).start()
 
-            if len(payments) > 0:
-                print("Bronze: Posting payment bills to WSIS.")
-                wsis.postBillPayment(payments, iqe, config["CashAccount"], config["AssetID"], utilityTown)
+        config["Profile"] = profileSettings(config, args)
+        profiler = newProfiler(config)
+        if profiler is not None:
+            print(f"Bronze: Profiling {', '.join(sorted(profiler.stages))} every {profiler.every} cycle(s) "
+                  f"into {profiler.directory}.")
 
-            print('Bronze: Sleeping for', SLEEP_TIME, 'seconds.')
-            time.sleep(SLEEP_TIME)
+        configs = townConfigs(config)
+        print(f"Bronze: Syncing {len(configs)} town(s).")
+        supervisor = Supervisor(configs, config.get("TownRetryInterval", 60), config.get("TownMaxRetryInterval", 900),
+                                profiler)
+        supervisor.start()
+        supervisor.wait()
 
     except http.client.HTTPException as e:
         print('Bronze HTTP exception: ', e)
     except Exception as e:
         print("Bronze generic exception occured: ", e)
     finally:
-        if 'iqe' in locals() or 'iqe' in globals():
-            iqe.disconnect()
+        if 'supervisor' in locals() or 'supervisor' in globals():
+            supervisor.stop()
 
-        if 'derash_client' in locals() or 'derash_client' in globals():
-            derash_client.disconnect()
+        if 'metricsServer' in locals() or 'metricsServer' in globals():
+            metricsServer.stop()
 
 
 if __name__ == '__main__':
-    Main()
\ No newline at end of file
+    Main()
@@ -0,0 +1,199 @@
+# File Desc: In-process counters, gauges and latency histograms for Bronze's hot paths (SQL, Derash,
+#   WSIS and the sync stages) and a small HTTP endpoint serving them in Prometheus text format
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import bisect
+import http.server
+import threading
+import time
+from contextlib import contextmanager
+
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    "bronze_http_request_seconds": "Latency of HTTP requests to Derash and WSIS until the response headers",
+    "bronze_http_requests_total": "HTTP requests to Derash and WSIS by response status",
+    "bronze_iqe_query_seconds": "Latency of iQE queries until the last row was fetched",
+    "bronze_iqe_rows_total": "Rows fetched by iQE queries",
+    "bronze_iqe_cache_total": "Lookups answered from the iQE cache (hit) or the database (miss)",
+    "bronze_stage_seconds": "Duration of sync stage runs",
+    "bronze_stage_work_total": "Work done by sync stages (bills synced, payments posted)",
+    "bronze_stage_errors_total": "Sync stage runs that failed",
+    "bronze_unpaid_bills": "Unpaid bills seen by the last full upload pass",
+    "bronze_payments": "Payments in the ledger by state",
+    "bronze_town_failures_total": "Failed attempts to start a town's sync loop",
+    "bronze_throttle_rate": "Requests per second a throttle currently lets through",
+    "bronze_throttle_waiting": "Requests waiting on a throttle",
+    "bronze_reconcile_differing_buckets": "Buckets whose WSIS and sync state aggregates differed in the last reconciliation",
+}
+
+
+class Metrics:
+    """
+    Registry of metrics keyed on name and labels. Updates are a dictionary lookup and an
+    addition under a lock, cheap enough for per-request use.
+    """
+    def __init__(self, buckets=BUCKETS):
+        """
+        :param buckets: upper bounds of the histogram buckets in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.counters = {}      # (name, labels) -> value
+        self.gauges = {}        # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+
+    def key(self, name, labels):
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Add's to a counter
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def set(self, name, value, **labels):
+        """
+        Set's a gauge
+        """
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = value
+
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record's a duration in a histogram
+        """
+        key = self.key(name, labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[index] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Time's the body of a with statement into a histogram
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+
+    def render(self):
+        """
+        :return: every metric in Prometheus text exposition format
+        """
+        with self.lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in HELP:
+                    lines.append(f"# HELP {name} {HELP[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{name}{formatLabels(labels)} {value}")
+
+        for (name, labels), value in gauges:
+            describe(name, "gauge")
+            lines.append(f"{name}{formatLabels(labels)} {value}")
+
+        for (name, labels), histogram in histograms:
+            describe(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), histogram):
+                cumulative += count
+                lines.append(f"{name}_bucket{formatLabels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{formatLabels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{formatLabels(labels)} {histogram[-1]}")
+
+        return '\n'.join(lines) + '\n'
+
+
+def formatLabels(labels):
+    """
+    :param labels: a tuple of (name, value) pairs
+    :return: the labels as {name="value",...}, empty if there are none
+    """
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+registry = Metrics()        # shared by every module of a Bronze process
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve's the registry on GET /metrics
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP endpoint for monitoring to scrape, serves from a daemon thread
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=9464, registry=registry):
+        """
+        :param host: the address to listen on, keep it local unless monitoring runs elsewhere
+        :param port: the port to listen on
+        :param registry: the Metrics to serve
+        """
+        super().__init__((host, port), MetricsHandler)
+        self.registry = registry
+        self.thread = None
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="bronze-metrics", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,127 @@
+# File Desc: A write-ahead journal (JSON lines) of the requests Bronze sends to change data on
+#   Derash or WSIS. An entry is appended before a request goes out and marked done once its
+#   response is in, so after a crash only the requests that were in flight need looking at.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import json
+import os
+import threading
+import time
+
+
+class Outbox:
+    """
+    Append only journal of outgoing POST/PUT requests, shared by the clients of a town
+    """
+    def __init__(self, path, fsync=False, compactAfter=10000):
+        """
+        :param path: the journal file, one per town
+        :param fsync: True to fsync every line; survives power loss too, at the cost of a disk
+            flush per request. Otherwise lines are flushed to the OS, which survives the process dying.
+        :param compactAfter: lines after which the file is truncated as soon as nothing is in flight
+        """
+        self.path = path
+        self.fsync = fsync
+        self.compactAfter = compactAfter
+        self.file = None
+        self.lock = threading.Lock()
+        self.nextID = 1
+        self.lines = 0
+        self.inFlight = set()           # ids appended but not done yet
+        self.recovered = []             # entries left in flight by the last run, see pending
+
+
+    def open(self):
+        """
+        Read's the journal left by the last run, keeps the entries that never got a response
+        for replay and starts a fresh file holding only those
+        """
+        entries = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue    # a line torn by the crash, its request was never sent
+                    if "done" in record:
+                        entries.pop(record["done"], None)
+                    else:
+                        entries[record["id"]] = record
+
+        self.recovered = list(entries.values())
+        self.nextID = max(entries, default=0) + 1
+
+        temp = self.path + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as file:
+            for entry in self.recovered:
+                file.write(json.dumps(entry) + '\n')
+        os.replace(temp, self.path)
+
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.lines = len(self.recovered)
+        self.inFlight = set(entries)
+
+
+    def close(self):
+        if self.file is not None:
+            with self.lock:
+                self.file.close()
+        self.file = None
+
+
+    def write(self, record):
+        # caller holds the lock
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.lines += 1
+
+
+    def append(self, target, method, url, body, meta=None):
+        """
+        Journal's a request before it is sent
+
+        :param target: derash or wsis
+        :param method: the HTTP verb
+        :param url: the path and query string
+        :param body: the JSON serializable request body
+        :param meta: what the caller needs to finish the job on replay (i.e. the bill's digest)
+        :return: the entry id to pass to done
+        """
+        with self.lock:
+            entryID = self.nextID
+            self.nextID += 1
+            self.write({"id": entryID, "target": target, "method": method, "url": url, "body": body,
+                        "meta": meta or {}, "time": time.time()})
+            self.inFlight.add(entryID)
+        return entryID
+
+
+    def done(self, entryID, status):
+        """
+        Mark's a request as answered, the file is truncated once it has grown past compactAfter
+        lines and no request is in flight
+
+        :param entryID: the id from append
+        :param status: the response status, kept for reading the journal by hand; None when the
+            request raised without an answer, the caller is left to sort out its outcome
+        """
+        with self.lock:
+            self.write({"done": entryID, "status": status})
+            self.inFlight.discard(entryID)
+
+            if self.lines >= self.compactAfter and len(self.inFlight) == 0:
+                self.file.truncate(0)
+                self.lines = 0
+
+
+    def pending(self, target):
+        """
+        :param target: derash or wsis
+        :return: the entries of a target left in flight by the last run, oldest first
+        """
+        return [entry for entry in self.recovered if entry["target"] == target and entry["id"] in self.inFlight]
@@ -0,0 +1,206 @@
+# File Desc: A local SQLite ledger of Derash payments keyed on their confirmation code, it lets
+#   Bronze skip payments it has already posted to WSIS and never post the same payment twice
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import sqlite3
+import threading
+from datetime import datetime
+
+from payment_reader import Payment
+
+
+# payment states
+DOWNLOADED = 'downloaded'       # seen in a Derash download, not yet posted
+POSTING = 'posting'             # a receipt was sent to WSIS, no answer recorded yet
+POSTED = 'posted'               # WSIS accepted the receipt
+FAILED = 'failed'               # WSIS rejected the receipt (4xx), retried with backoff up to maxAttempts
+UNKNOWN = 'unknown'             # WSIS answered with an error it may have booked the receipt on, never resent
+
+
+class PaymentLedger:
+    """
+    Persistent record of every Derash payment Bronze has handled and its state
+    """
+    def __init__(self, path, maxAttempts=5, retryBackoff=300, maxRetryBackoff=21600):
+        """
+        :param path: the SQLite database file, may be the same file used by SyncState
+        :param maxAttempts: receipts sent for a payment before a rejected one is no longer retried
+        :param retryBackoff: seconds after a first rejection before the payment is retried, doubled
+            for every attempt after
+        :param maxRetryBackoff: upper bound of the wait between retries
+        """
+        self.path = path
+        self.maxAttempts = maxAttempts
+        self.retryBackoff = retryBackoff
+        self.maxRetryBackoff = maxRetryBackoff
+        self.conn = None
+        self.lock = threading.Lock()
+
+
+    def open(self):
+        """
+        Open's (or creates) the SQLite file and the payments table
+        """
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS payments ("
+            "confirmationCode TEXT NOT NULL PRIMARY KEY, billID TEXT, amount REAL, agent TEXT, "
+            "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated TEXT NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ixPaymentsState ON payments (state)")
+        self.conn.commit()
+
+
+    def close(self):
+        """
+        Commit's any pending writes and closes the file
+        """
+        if self.conn is not None:
+            with self.lock:
+                self.conn.commit()
+            self.conn.close()
+        self.conn = None
+
+
+    def getState(self, confirmationCode):
+        """
+        :return: the state of a payment or None if it was never seen before
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM payments WHERE confirmationCode = ?", (confirmationCode,)).fetchone()
+        return None if row is None else row[0]
+
+
+    def markDownloaded(self, payment):
+        """
+        Record's a payment seen in a Derash download, payments already in the ledger are
+        left as they are
+
+        :param payment: a Payment record
+        :return: the state of the payment after the call
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM payments WHERE confirmationCode = ?", (payment.confirmationCode,)).fetchone()
+            if row is not None:
+                return row[0]
+
+            self.conn.execute(
+                "INSERT INTO payments (confirmationCode, billID, amount, agent, state, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (payment.confirmationCode, payment.billID, payment.amount, payment.agent, DOWNLOADED, self.now()))
+            self.conn.commit()  # don't hold the write lock, the file is shared with SyncState
+        return DOWNLOADED
+
+
+    def markPosting(self, confirmationCode):
+        """
+        Record's that a receipt is about to be sent to WSIS, committed right away so that a
+        crash before the answer leaves the payment in POSTING rather than open for reposting
+        """
+        self.setState(confirmationCode, POSTING, None, attempt=True)
+
+
+    def markPosted(self, confirmationCode):
+        """
+        Record's that WSIS accepted the receipt of a payment
+        """
+        self.setState(confirmationCode, POSTED, None)
+
+
+    def markFailed(self, confirmationCode, error):
+        """
+        Record's that WSIS rejected the receipt of a payment, it will be retried unless it's
+        out of attempts
+
+        :return: True if the payment is out of attempts and won't be retried
+        """
+        self.setState(confirmationCode, FAILED, str(error))
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT attempts FROM payments WHERE confirmationCode = ?", (confirmationCode,)).fetchone()
+        return row is not None and row[0] >= self.maxAttempts
+
+
+    def markUnknown(self, confirmationCode, error):
+        """
+        Record's that WSIS answered the receipt of a payment with an error that doesn't rule
+        out the receipt being booked (i.e. a 5xx); it's reported, not sent again
+        """
+        self.setState(confirmationCode, UNKNOWN, str(error))
+
+
+    def setState(self, confirmationCode, state, error, attempt=False):
+        """
+        Update's and commits the state of a payment
+        """
+        with self.lock:
+            self.conn.execute(
+                "UPDATE payments SET state = ?, error = ?, updated = ?, attempts = attempts + ? "
+                "WHERE confirmationCode = ?",
+                (state, error, self.now(), 1 if attempt else 0, confirmationCode))
+            self.conn.commit()
+
+
+    def isDue(self, attempts, updated):
+        """
+        :param attempts: the receipts sent for a rejected payment so far
+        :param updated: when the payment was last rejected, as stored
+        :return: True if the payment may be retried now
+        """
+        if attempts >= self.maxAttempts:
+            return False
+        delay = min(self.maxRetryBackoff, self.retryBackoff * 2 ** max(0, attempts - 1))
+        return (datetime.now() - datetime.fromisoformat(updated)).total_seconds() >= delay
+
+
+    def isRetryDue(self, confirmationCode):
+        """
+        :return: True if a rejected payment may be retried now
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT attempts, updated FROM payments WHERE confirmationCode = ? AND state = ?",
+                (confirmationCode, FAILED)).fetchone()
+        return row is not None and self.isDue(*row)
+
+
+    def getRetryable(self):
+        """
+        Get's the payments that still need posting; those WSIS rejected whose backoff is over
+        and those downloaded but never sent (i.e. Bronze stopped before their turn came).
+        Their download window may already be behind the download cursor, so they are rebuilt
+        from the ledger.
+
+        :return: a list of Payment records
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT billID, amount, agent, confirmationCode, state, attempts, updated FROM payments "
+                "WHERE state = ? OR (state = ? AND attempts < ?)", (DOWNLOADED, FAILED, self.maxAttempts)).fetchall()
+        return [Payment(*row[:4]) for row in rows if row[4] == DOWNLOADED or self.isDue(row[5], row[6])]
+
+
+    def count(self, state):
+        """
+        :return: the number of payments in a given state
+        """
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM payments WHERE state = ?", (state,)).fetchone()[0]
+
+
+    def countGivenUp(self):
+        """
+        :return: the number of rejected payments out of attempts, left for checking by hand
+        """
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM payments WHERE state = ? AND attempts >= ?",
+                                     (FAILED, self.maxAttempts)).fetchone()[0]
+
+
+    def now(self):
+        return datetime.now().isoformat(timespec='seconds')
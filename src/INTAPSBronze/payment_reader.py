@@ -0,0 +1,46 @@
+# File Desc: Streaming reader for the paid bill CSV downloaded from INSA Derash, it parses the
+#   response body as it arrives into typed Payment records
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import csv
+import io
+from collections import namedtuple
+
+
+MIN_COLUMNS = 8         # the paid bill CSV has at least this many columns
+
+Payment = namedtuple('Payment', ['billID', 'amount', 'agent', 'confirmationCode'])
+
+
+def readPayments(stream, town):
+    """
+    Parses the Derash paid bill CSV from a binary stream (i.e. an HTTP response) one row
+    at a time and yield's a Payment record per row. The header row is skipped, quoted
+    fields are handled by the csv module and short rows are reported and skipped.
+
+    :param stream: a binary file like object with the CSV body
+    :param town: the utility town prefix, removed from Derash bill_id's to get WSIS bill id's
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    rows = csv.reader(text)
+    next(rows, None)    # header
+
+    for row in rows:
+        if len(row) < MIN_COLUMNS:
+            if len(row) > 0:
+                print(f"Bronze: skipping malformed payment row {row}")
+            continue
+
+        billID = row[3].strip()
+        if billID.startswith(town):
+            billID = billID[len(town):]
+
+        try:
+            amount = float(row[4])
+        except ValueError:
+            print(f"Bronze: skipping payment row with bad amount {row}")
+            continue
+
+        yield Payment(billID, amount, row[-2], row[-1])
@@ -0,0 +1,232 @@
+# File Desc: An opt-in profiling mode for live runs. Every N cycles of a chosen sync stage, the cycle
+#   runs under cProfile and tracemalloc and the stats are written to rotating files, so a stage that
+#   slows down or grows in memory can be looked into without restarting under a debugger.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import cProfile
+import glob
+import inspect
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import types
+from datetime import datetime
+
+
+# the functions a profile can be asked for by, and the stage whose cycles run them
+ALIASES = {
+    "uploadDerash": "upload",
+    "invalidateBill": "invalidate",
+    "downloadPayment": "payments",
+    "postBillPayment": "payments",
+}
+
+# profiles every stage but only reports the functions of iqe.py, i.e. the queries
+IQE = "iqe"
+
+
+@types.coroutine
+def stepProfiled(profile, steps):
+    """
+    Drive's a coroutine's steps (its __await__ iterator) with profile enabled around each of
+    them and disabled while it's suspended
+
+    :return: the coroutine's result
+    """
+    value, error = None, None
+    while True:
+        try:
+            profile.enable()
+            if error is None:
+                suspended = steps.send(value)
+            else:
+                suspended = steps.throw(error)
+        except StopIteration as e:
+            return e.value
+        finally:
+            profile.disable()
+
+        try:
+            value, error = (yield suspended), None
+        except GeneratorExit:
+            steps.close()
+            raise
+        except BaseException as e:
+            value, error = None, e
+
+
+class Profiler:
+    """
+    Wrap's stage functions so every every-th cycle of the chosen stages is profiled
+    """
+    def __init__(self, stages, every=10, directory="profiles", keep=20, top=25, frames=1):
+        """
+        :param stages: the stage names to profile (upload, invalidate, payments, reconcile), the
+            functions in ALIASES or iqe for the database queries of every stage
+        :param every: profile one cycle in this many, the first cycle is always profiled
+        :param directory: where the profile files go, created if missing
+        :param keep: the number of profiles kept per town and stage, older ones are deleted
+        :param top: the number of functions and allocation sites listed in a report
+        :param frames: frames of traceback kept per allocation, more costs memory while tracing
+        """
+        self.stages = {ALIASES.get(stage, stage) for stage in stages}
+        self.every = max(1, int(every))
+        self.directory = directory
+        self.keep = max(1, int(keep))
+        self.top = top
+        self.frames = frames
+        self.cycles = {}                # (town, stage) -> cycles run
+        self.active = False             # a cycle is being profiled
+        self.lock = threading.Lock()
+
+
+    def wrap(self, town, stage, func):
+        """
+        :param town: the town prefix
+        :param stage: the stage name
+        :param func: the stage function, a plain or an async one
+        :return: func, profiled every every-th call if the stage was chosen
+        """
+        if stage not in self.stages and IQE not in self.stages:
+            return func
+
+        def profiled():
+            if not self.due(town, stage):
+                return func()
+
+            profile = self.begin(town, stage)
+            if profile is None:
+                return func()
+            try:
+                result = func()
+                profile.disable()
+            except BaseException:
+                self.end(town, stage, profile)
+                raise
+
+            if inspect.isawaitable(result):
+                return self.awaitProfiled(town, stage, profile, result)
+            self.end(town, stage, profile)
+            return result
+
+        return profiled
+
+
+    async def awaitProfiled(self, town, stage, profile, awaitable):
+        """
+        Finishes profiling a cycle of the asyncio runtime. The profile is only on while the
+        cycle's own task steps, so the other tasks of the event loop stay out of it.
+        """
+        try:
+            return await stepProfiled(profile, awaitable.__await__())
+        finally:
+            self.end(town, stage, profile)
+
+
+    def due(self, town, stage):
+        """
+        :return: True if this cycle of a stage is to be profiled, the profiler is then held
+            until end. Only one cycle is profiled at a time (a profile and tracemalloc see the
+            whole thread or process); a stage whose turn comes while another is profiled keeps
+            its turn for its next cycle.
+        """
+        with self.lock:
+            cycle = self.cycles.get((town, stage), 0)
+            if cycle % self.every == 0 and self.active:
+                return False
+            self.cycles[(town, stage)] = cycle + 1
+            if cycle % self.every != 0:
+                return False
+            self.active = True
+            return True
+
+
+    def begin(self, town, stage):
+        """
+        Start's tracing allocations and a profile of the calling thread for a due cycle
+
+        :return: the running profile, None if another profiler holds the interpreter (from
+            Python 3.12 only one runs at a time) and this cycle goes unprofiled
+        """
+        tracemalloc.start(self.frames)
+        profile = cProfile.Profile()
+        profile.start = time.perf_counter()
+        try:
+            profile.enable()
+        except ValueError as e:
+            print(f"Bronze: skipped profiling {town}{stage}: {e}")
+            self.release()
+            return None
+        return profile
+
+
+    def release(self):
+        """
+        Stop's tracing allocations and lets the next due cycle be profiled
+        """
+        tracemalloc.stop()
+        with self.lock:
+            self.active = False
+
+
+    def end(self, town, stage, profile):
+        """
+        Stop's a profile and tracing, writes its files and lets the next cycle be profiled
+        """
+        profile.disable()
+        seconds = time.perf_counter() - profile.start
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        self.release()
+
+        try:
+            self.write(town, stage, profile, snapshot, seconds, current, peak)
+        except OSError as e:
+            print(f"Bronze: writing the profile of {town}{stage} failed: {e}")
+
+
+    def write(self, town, stage, profile, snapshot, seconds, current, peak):
+        """
+        Write's a profiled cycle as <town><stage>-<time>.prof (pstats, for snakeviz and the like)
+        and a .txt report of the top functions by cumulative time and the top allocation sites
+        still holding memory at the end of the cycle, then deletes the oldest beyond keep
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, f"{town}{stage}-{datetime.now():%Y%m%d-%H%M%S-%f}")
+        profile.dump_stats(name + '.prof')
+
+        text = io.StringIO()
+        text.write(f"{town}{stage} cycle of {seconds:.3f}s, traced memory {current / 2**20:.2f} MB "
+                   f"held at the end, {peak / 2**20:.2f} MB at peak\n\n")
+        stats = pstats.Stats(profile, stream=text).strip_dirs().sort_stats('cumulative')
+        if IQE in self.stages and stage not in self.stages:
+            stats.print_stats(r'iqe\.py', self.top)
+        else:
+            stats.print_stats(self.top)
+
+        text.write("Top allocations still held at the end of the cycle\n")
+        ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        for stat in snapshot.filter_traces(ignored).statistics('lineno')[:self.top]:
+            text.write(f"{stat}\n")
+
+        with open(name + '.txt', 'w', encoding='utf-8') as file:
+            file.write(text.getvalue())
+        print(f"Bronze: profile of {town}{stage} written to {name}.txt")
+        self.rotate(town, stage)
+
+
+    def rotate(self, town, stage):
+        """
+        Delete's the oldest profiles of a town's stage beyond keep
+        """
+        names = sorted(glob.glob(os.path.join(glob.escape(self.directory), glob.escape(f"{town}{stage}-") + '*.txt')))
+        for old in names[:-self.keep]:
+            base = old[:-len('.txt')]
+            for path in (base + '.txt', base + '.prof'):
+                if os.path.exists(path):
+                    os.remove(path)
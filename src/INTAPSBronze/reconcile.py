@@ -0,0 +1,140 @@
+# File Desc: A cheap consistency check between the unpaid bills in WSIS and what Bronze recorded as
+#   sent to INSA Derash. Bills are grouped into hash buckets and compared bucket by bucket on count,
+#   amount and a digest; only the buckets that differ are compared bill by bill.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import zlib
+
+from metrics import registry
+
+
+def bucketOf(billID, buckets):
+    """
+    :param billID: the aggregated WSIS bill ids of a customer
+    :param buckets: the number of buckets
+    :return: the bucket of a bill, stable across runs and processes
+    """
+    return zlib.crc32(str(billID).encode('utf-8')) % buckets
+
+
+class Reconciler:
+    """
+    Compare's WSIS's unpaid bills with a town's SyncState records. A bucket holds the number
+    of bills, their amount in cents and the XOR of their content hashes, so it is the same
+    on both sides whatever order the bills come in.
+    """
+    def __init__(self, syncState, town, buckets=1024, client=None):
+        """
+        :param syncState: the opened SyncState of the town
+        :param town: the utility town prefix
+        :param buckets: the number of buckets, more means smaller drill downs
+        :param client: a DerashClient to resync differing bills with, None to only report them
+        """
+        self.syncState = syncState
+        self.town = town
+        self.buckets = max(1, int(buckets))
+        self.client = client
+
+
+    def aggregate(self, rows):
+        """
+        Fold's (billID, amount, digest) rows into buckets
+
+        :param rows: an iterable of (billID, amount, digest)
+        :return: a dictionary of bucket to (count, cents, digest)
+        """
+        buckets = {}
+        for billID, amount, digest in rows:
+            bucket = bucketOf(billID, self.buckets)
+            count, cents, xor = buckets.get(bucket, (0, 0, 0))
+            buckets[bucket] = (count + 1, cents + round(float(amount) * 100), xor ^ int(digest, 16))
+        return buckets
+
+
+    def run(self, iqe, repair=False):
+        """
+        Run's a reconciliation pass; one streamed read of the unpaid bills (a second one only
+        when some bucket differs) and no request to Derash for the buckets that match. With
+        repair, stale and missing bills are synced with Derash right away and records of bills
+        no longer unpaid are dropped.
+
+        :param iqe: the database engine to read the unpaid bills with
+        :param repair: True to fix what differs, False to only report it
+        :return: a dictionary of the number of bills, buckets that differ, and the billIDs that
+            are missing (unpaid but never recorded), stale (recorded with other content) and
+            orphaned (recorded but no longer unpaid)
+        """
+        report = {"bills": 0, "buckets": self.buckets, "differing": 0, "missing": [], "stale": [], "orphaned": []}
+        # until an upload pass has gone over every unpaid bill, bills look missing only because the
+        # upload hasn't reached them yet and repairing them would race it
+        if self.syncState.getCursor(self.town + 'fullUpload') is None:
+            print(f"Bronze: {self.town} reconciliation waits for a full upload pass.")
+            return report
+
+        period = iqe.getCurrentPeriod()
+        dueDate = iqe.getDueDate()
+        digest = self.syncState.digest
+
+        bills = iqe.iterUnpaidBills(incremental=False)
+        try:
+            wsis = self.aggregate((bill.billID, bill.amount, digest(bill, period, dueDate)) for bill in bills)
+        finally:
+            bills.close()
+
+        records = self.syncState.getRecords(self.town)
+        recorded = self.aggregate((billID, amount, hashed) for billID, _, amount, hashed in records)
+        differing = {bucket for bucket in wsis.keys() | recorded.keys() if wsis.get(bucket) != recorded.get(bucket)}
+
+        report["bills"] = sum(count for count, _, _ in wsis.values())
+        report["differing"] = len(differing)
+        found = {}
+        if differing:
+            bills = iqe.iterUnpaidBills(incremental=False)
+            try:
+                for bill in bills:
+                    if bucketOf(bill.billID, self.buckets) in differing:
+                        found[str(bill.billID)] = bill
+            finally:
+                bills.close()
+
+            kept = {billID: hashed for billID, _, _, hashed in records if bucketOf(billID, self.buckets) in differing}
+            for billID, bill in found.items():
+                if billID not in kept:
+                    report["missing"].append(billID)
+                elif kept[billID] != digest(bill, period, dueDate):
+                    report["stale"].append(billID)
+            report["orphaned"] = [billID for billID in kept if billID not in found]
+
+        if repair and differing:
+            self.repair(report, found, period, dueDate)
+
+        registry.set("bronze_reconcile_differing_buckets", len(differing), town=self.town)
+        print(f"Bronze: {self.town} reconciliation of {report['bills']} bills, {len(differing)}/{self.buckets} "
+              f"buckets differ; {len(report['missing'])} missing, {len(report['stale'])} stale, "
+              f"{len(report['orphaned'])} orphaned.")
+        return report
+
+
+    def repair(self, report, bills, period, dueDate):
+        """
+        Resync's the missing and stale bills of a report with Derash and drops the orphaned
+        records. Orphans are not touched on Derash; a customer's bill set changing leaves one
+        behind as well as a bill being paid.
+        """
+        if report["orphaned"]:
+            self.syncState.forgetMany(self.town, report["orphaned"])
+
+        if self.client is None:
+            return
+
+        resync = [bills[billID] for billID in report["missing"] + report["stale"]]
+        sync = lambda bill: self.client.syncBill(bill, period, dueDate)
+        failed = 0
+        for result in self.client.runConcurrent(sync, resync, self.client.workers):
+            if result["action"] == "failed":
+                failed += 1
+                print(f"Derash resync failed for bill {result['billID']}: {result['error']}")
+        self.syncState.commit()
+        report["failed"] = failed
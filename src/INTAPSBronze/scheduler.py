@@ -0,0 +1,156 @@
+# File Desc: A small scheduler that runs each of Bronze's sync stages (bill upload, invalidation,
+#   payment download/posting) on a thread and interval of its own
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import threading
+import time
+
+from metrics import registry
+
+
+class Stage:
+    """
+    A unit of periodic work. The stage function returns the amount of work it did (i.e.
+    bills uploaded or payments posted), which the scheduler uses to pace the next run.
+    """
+    def __init__(self, name, func, interval, maxInterval=None, batchLimit=None, town=""):
+        """
+        :param name: the stage name used in log lines
+        :param func: a callable taking no arguments and returning the amount of work done
+        :param interval: seconds between runs while the stage finds work
+        :param maxInterval: upper bound of the backoff when the stage finds no work
+        :param batchLimit: amount of work per run after which the stage is run again right away
+        :param town: the town the stage syncs when running several, used in log lines and metrics
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.maxInterval = maxInterval if maxInterval is not None else interval
+        self.batchLimit = batchLimit
+        self.town = town
+
+        self.delay = interval           # current wait before the next run
+        self.lock = threading.Lock()    # held while the stage runs, no two runs overlap
+        self.lastRun = None
+        self.lastDuration = 0.0
+        self.lastWork = 0
+        self.lastError = None
+
+
+    def run(self):
+        """
+        Run's the stage once unless it's already running, then work's out the delay to the
+        next run; right away when the batch limit was hit, doubled (up to maxInterval) when
+        there was no work or an error, the normal interval otherwise.
+
+        :return: False if the stage was already running
+        """
+        if not self.lock.acquire(blocking=False):
+            return False
+
+        try:
+            start = time.monotonic()
+            try:
+                work = self.func() or 0
+                error = None
+            except Exception as e:
+                work = 0
+                error = e
+            self.finish(start, work, error)
+        finally:
+            self.lock.release()
+
+        return True
+
+
+    def finish(self, start, work, error):
+        """
+        Record's the outcome of a run and work's out the delay to the next one, shared with
+        the asyncio runtime which awaits the stage function instead of calling it
+
+        :param start: time.monotonic() when the run started
+        :param work: the amount of work the run did
+        :param error: the exception the run failed with, None on success
+        """
+        self.lastRun = start
+        self.lastDuration = time.monotonic() - start
+        self.lastWork = work
+        self.lastError = error
+        if error is not None:
+            print(f"Bronze: stage {self.town}{self.name} failed: {error}")
+
+        registry.observe("bronze_stage_seconds", self.lastDuration, stage=self.name, town=self.town)
+        registry.inc("bronze_stage_work_total", work, stage=self.name, town=self.town)
+        if error is not None:
+            registry.inc("bronze_stage_errors_total", stage=self.name, town=self.town)
+
+        if error is None and self.batchLimit is not None and work >= self.batchLimit:
+            self.delay = 0
+        elif error is not None or work == 0:
+            self.delay = min(max(self.delay, self.interval) * 2, self.maxInterval)
+        else:
+            self.delay = self.interval
+
+
+class Scheduler:
+    """
+    Run's every stage on a thread of its own so a long stage (i.e. a full bill upload) does
+    not hold back a latency sensitive one (i.e. payments)
+    """
+    def __init__(self):
+        self.stages = []
+        self.threads = []
+        self.stopping = threading.Event()
+
+
+    def add(self, stage):
+        """
+        :param stage: a Stage to schedule, must be added before start
+        """
+        self.stages.append(stage)
+
+
+    def loop(self, stage):
+        """
+        The body of a stage thread; run's the stage, waits its delay and repeats until stopped
+        """
+        while not self.stopping.is_set():
+            stage.run()
+            if stage.delay > 0:
+                self.stopping.wait(stage.delay)
+
+
+    def start(self):
+        """
+        Start's a daemon thread per stage, stages run immediately
+        """
+        for stage in self.stages:
+            thread = threading.Thread(target=self.loop, args=(stage,), name=f"bronze-{stage.town}{stage.name}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def stop(self, timeout=None):
+        """
+        Signal's every stage to stop and waits for the ones running to finish
+
+        :param timeout: seconds to wait for each stage thread
+        """
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+
+    def wait(self):
+        """
+        Block's the calling thread until the scheduler is stopped (i.e. on Ctrl+C)
+        """
+        try:
+            while not self.stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            print("Bronze: Stopping.")
+            self.stop()
@@ -0,0 +1,94 @@
+# File Desc: Compiles the SQL scripts in scripts.json once into named statements with typed `?`
+#   parameters, so iQE never rebuilds SQL text per call and SQL Server can reuse its plans
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import threading
+
+
+# parameter types that may be declared in the "params" section of scripts.json
+TYPES = {
+    "int": int,
+    "float": float,
+    "str": str,
+}
+
+
+class Statement:
+    """
+    A compiled SQL statement; its text, declared parameter types and execution stats
+    """
+    def __init__(self, name, sql, params=()):
+        """
+        :param name: the script name in scripts.json
+        :param sql: the statement text, lines already joined
+        :param params: the type names of its `?` parameters in order
+        """
+        unknown = [param for param in params if param not in TYPES]
+        if unknown:
+            raise ValueError(f"{name}: unknown parameter type(s) {unknown}")
+        if sql.count('?') != len(params):
+            raise ValueError(f"{name}: has {sql.count('?')} parameter marker(s) but {len(params)} declared")
+
+        self.name = name
+        self.sql = sql
+        self.params = tuple(params)
+        self.converters = tuple(TYPES[param] for param in params)
+
+        self.calls = 0
+        self.rows = 0
+        self.seconds = 0.0
+        self.lock = threading.Lock()
+
+
+    def bind(self, args):
+        """
+        Check's and converts call arguments to the declared parameter types
+
+        :param args: the parameter values in order
+        :return: a tuple of converted values to pass to cursor.execute
+        """
+        if len(args) != len(self.converters):
+            raise TypeError(f"{self.name} takes {len(self.converters)} parameter(s), {len(args)} given")
+        return tuple(None if arg is None else convert(arg) for convert, arg in zip(self.converters, args))
+
+
+    def record(self, seconds, rows):
+        """
+        Add's an execution to the statement's stats
+        """
+        with self.lock:
+            self.calls += 1
+            self.rows += rows
+            self.seconds += seconds
+
+
+    def stats(self):
+        """
+        :return: a dictionary of calls, rows, total and average seconds
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "rows": self.rows,
+                "seconds": self.seconds,
+                "average": self.seconds / self.calls if self.calls else 0.0,
+            }
+
+
+def compileScripts(scripts):
+    """
+    Compile's the contents of scripts.json into statements. Each script under "qwery" is a list
+    of lines (or a string); the types of a script's `?` parameters are declared under
+    "params" by the same name, scripts without an entry take no parameters.
+
+    :param scripts: the parsed scripts.json
+    :return: a dictionary of statement name to Statement
+    """
+    params = scripts.get("params", {})
+    statements = {}
+    for name, lines in scripts["qwery"].items():
+        sql = lines if isinstance(lines, str) else ' '.join(lines)
+        statements[name] = Statement(name, sql, params.get(name, ()))
+    return statements
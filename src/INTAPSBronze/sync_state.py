@@ -0,0 +1,243 @@
+# File Desc: A local SQLite index of what Bronze has already sent to INSA Derash, used to skip
+#   bills whose content has not changed since the last upload without asking Derash about them
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import hashlib
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+class SyncState:
+    """
+    Persistent index mapping each town + billID to the amount, due date and content hash
+    last uploaded to Derash
+    """
+    def __init__(self, path):
+        """
+        :param path: the SQLite database file, normally next to appsettings.json
+        """
+        self.path = path
+        self.conn = None
+        self.lock = threading.Lock()
+
+
+    def open(self):
+        """
+        Open's (or creates) the SQLite file and its tables
+        """
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS bills ("
+            "town TEXT NOT NULL, billID TEXT NOT NULL, derashID TEXT, amount REAL, "
+            "dueDate TEXT, hash TEXT NOT NULL, updated TEXT NOT NULL, "
+            "PRIMARY KEY (town, billID))")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cursors ("
+            "name TEXT NOT NULL PRIMARY KEY, value TEXT, updated TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS derashIDs ("
+            "town TEXT NOT NULL, billID TEXT NOT NULL, derashID TEXT NOT NULL, "
+            "PRIMARY KEY (town, billID))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ixDerashIDs ON derashIDs (derashID)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS derashMisses ("
+            "town TEXT NOT NULL, billSet TEXT NOT NULL, expires REAL NOT NULL, "
+            "PRIMARY KEY (town, billSet))")
+        self.conn.commit()
+
+
+    def close(self):
+        """
+        Commit's any pending writes and closes the file
+        """
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+        self.conn = None
+
+
+    def commit(self):
+        """
+        Flushes pending writes to disk
+        """
+        with self.lock:
+            self.conn.commit()
+
+
+    def digest(self, bill, period, dueDate):
+        """
+        Computes the content hash of a bill as it would be sent to Derash
+
+        :param bill: the bill info from WSIS
+        :param period: the current bill period
+        :param dueDate: the last allowed payment date
+        :return: hex digest of the bill content
+        """
+        content = '|'.join(str(value) for value in (
+            bill.billID, f'{float(bill.amount):.2f}', dueDate, period,
+            bill.customerCode, bill.contractNo, bill.name, bill.phoneNo, bill.email))
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+    def isUnchanged(self, town, billID, digest):
+        """
+        :return: True if the bill was uploaded before with exactly the same content
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT hash FROM bills WHERE town = ? AND billID = ?", (town, str(billID))).fetchone()
+        return row is not None and row[0] == digest
+
+
+    def record(self, town, billID, derashID, amount, dueDate, digest):
+        """
+        Remember's a bill as being in sync with Derash
+
+        :param town: the utility town prefix
+        :param billID: the aggregated WSIS bill ids
+        :param derashID: the bill_id Derash knows the bill by
+        :param amount: the amount uploaded
+        :param dueDate: the due date uploaded
+        :param digest: content hash from digest
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO bills (town, billID, derashID, amount, dueDate, hash, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (town, str(billID), derashID, round(float(amount), 2), str(dueDate), digest,
+                 datetime.now().isoformat(timespec='seconds')))
+            self.conn.commit()  # don't hold the write lock, the file is shared with PaymentLedger
+
+
+    def forget(self, town, billID):
+        """
+        Drop's a bill from the index so the next upload checks it with Derash again
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM bills WHERE town = ? AND billID = ?", (town, str(billID)))
+            self.conn.commit()
+
+
+    def forgetMany(self, town, billIDs):
+        """
+        Drop's several bills from the index in one transaction
+        """
+        with self.lock:
+            self.conn.executemany("DELETE FROM bills WHERE town = ? AND billID = ?",
+                                  [(town, str(billID)) for billID in billIDs])
+            self.conn.commit()
+
+
+    def getRecords(self, town):
+        """
+        :param town: the utility town prefix
+        :return: a list of (billID, derashID, amount, hash) of every bill recorded for a town
+        """
+        with self.lock:
+            return self.conn.execute(
+                "SELECT billID, derashID, amount, hash FROM bills WHERE town = ?", (town,)).fetchall()
+
+
+    def getCursor(self, name):
+        """
+        :param name: the name of the cursor, i.e. town + what it tracks
+        :return: the persisted value of a cursor or None if it was never set
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cursors WHERE name = ?", (name,)).fetchone()
+        return None if row is None else row[0]
+
+
+    def setCursor(self, name, value):
+        """
+        Persist's the value of a cursor, committed right away so progress survives a crash
+
+        :param name: the name of the cursor
+        :param value: the new value, stored as a string
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cursors (name, value, updated) VALUES (?, ?, ?)",
+                (name, str(value), datetime.now().isoformat(timespec='seconds')))
+            self.conn.commit()
+
+
+    def findDerashID(self, town, billIDs):
+        """
+        Look's up the Derash bill_id any of a customer's WSIS bills was last known by
+
+        :param town: the utility town prefix
+        :param billIDs: the individual WSIS bill ids of the customer
+        :return: the Derash bill_id or None if none of the bills is known
+        """
+        billIDs = [str(billID) for billID in billIDs]
+        if len(billIDs) == 0:
+            return None
+
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT billID, derashID FROM derashIDs WHERE town = ? AND billID IN ({','.join('?' * len(billIDs))})",
+                [town] + billIDs).fetchall()
+
+        known = dict(rows)
+        for billID in billIDs:      # the aggregate is ordered, prefer the oldest bill
+            if billID in known:
+                return known[billID]
+        return None
+
+
+    def rememberDerashID(self, town, billIDs, derashID):
+        """
+        Record's the Derash bill_id a set of WSIS bills is known by and clears any cached miss
+
+        :param town: the utility town prefix
+        :param billIDs: the individual WSIS bill ids of the customer
+        :param derashID: the bill_id found on (or uploaded to) Derash
+        """
+        billIDs = [str(billID) for billID in billIDs]
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO derashIDs (town, billID, derashID) VALUES (?, ?, ?)",
+                [(town, billID, derashID) for billID in billIDs])
+            self.conn.execute("DELETE FROM derashMisses WHERE town = ? AND billSet = ?", (town, ','.join(billIDs)))
+            self.conn.commit()
+
+
+    def forgetDerashID(self, town, derashID):
+        """
+        Drop's a Derash bill_id that Derash no longer knows of
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM derashIDs WHERE town = ? AND derashID = ?", (town, derashID))
+            self.conn.commit()
+
+
+    def isKnownMiss(self, town, billSet):
+        """
+        :param billSet: the aggregated (comma separated) WSIS bill ids
+        :return: True if Derash recently had none of the bills in the set
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT expires FROM derashMisses WHERE town = ? AND billSet = ?", (town, str(billSet))).fetchone()
+        return row is not None and row[0] > time.time()
+
+
+    def rememberMiss(self, town, billSet, ttl):
+        """
+        Record's that Derash has none of the bills in a set, for ttl seconds
+
+        :param billSet: the aggregated (comma separated) WSIS bill ids
+        :param ttl: seconds the miss is trusted for
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO derashMisses (town, billSet, expires) VALUES (?, ?, ?)",
+                (town, str(billSet), time.time() + ttl))
+            self.conn.commit()
@@ -0,0 +1,196 @@
+# File Desc: Token bucket pacing of the requests Bronze sends to INSA Derash. The rate adapts to the
+#   server; it is cut to 0.7 of itself (by default) when Derash answers 429 or 503 (and paused for
+#   any Retry-After), and creeps back up while requests go through, so Bronze runs about as fast as
+#   Derash tolerates.
+#
+# Program Author: Rediet Worku aka Aethiops II ben Zahab
+#
+# Date Created: 18th of October 2026, Sunday
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from metrics import registry
+
+
+# response statuses by which a server asks us to slow down
+THROTTLED = (429, 503)
+
+
+def parseRetryAfter(value):
+    """
+    :param value: a Retry-After header, seconds or an HTTP date
+    :return: the seconds to wait, None if the header is missing or can't be read
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Let's through rate requests a second on average with bursts of up to burst requests.
+    A token is reserved as soon as a request asks for one, so waiting requests go in
+    turn rather than racing each other.
+    """
+    def __init__(self, rate, burst=None, minRate=1, maxRate=None):
+        """
+        :param rate: the requests per second to start at
+        :param burst: the most requests let through at once after a quiet spell, defaults to rate
+        :param minRate: the lowest rate backing off may go down to
+        :param maxRate: the highest rate recovering may go up to, defaults to rate
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.minRate = float(minRate)
+        self.maxRate = float(maxRate or rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.pausedUntil = 0.0          # time.monotonic() before which nothing is let through
+        self.lastBackoff = 0.0
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+
+    def reserve(self):
+        """
+        Take's a token, going into debt when there is none
+
+        :return: seconds to wait before the request may go
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate, self.pausedUntil - now)
+
+
+    def backoff(self, factor, retryAfter=None):
+        """
+        Cut's the rate by factor, at most once a second since a burst of requests in flight
+        all get throttled together, and pauses for retryAfter seconds if given
+
+        :return: True if the rate was cut
+        """
+        with self.lock:
+            now = time.monotonic()
+            if retryAfter is not None:
+                self.pausedUntil = max(self.pausedUntil, now + retryAfter)
+            if now - self.lastBackoff < 1:
+                return False
+            self.rate = max(self.minRate, self.rate * factor)
+            self.lastBackoff = now
+            return True
+
+
+    def recover(self, increase):
+        """
+        Raise's the rate by increase for a request that went through, at rate requests a
+        second the rate then grows by a fraction increase of itself every second
+        """
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + increase)
+
+
+class Throttle:
+    """
+    Paces the requests of every Derash client of a town through one shared bucket and,
+    for endpoints configured with a rate of their own, an endpoint bucket as well
+    """
+    def __init__(self, name, rate=20, burst=None, minRate=1, maxRate=100, increase=0.1, decrease=0.7,
+                 endpoints=None):
+        """
+        :param name: labels the metrics, i.e. the town
+        :param rate: shared requests per second to start at
+        :param burst: shared burst size, defaults to rate
+        :param minRate: the lowest a rate backs off to
+        :param maxRate: the highest a rate recovers to
+        :param increase: requests per second a rate grows by for every request that goes through
+        :param decrease: factor a rate is cut by on 429 or 503
+        :param endpoints: dictionary of path to {"rate", "burst", "minRate", "maxRate"}
+        """
+        self.name = name
+        self.increase = increase
+        self.decrease = decrease
+        self.shared = TokenBucket(rate, burst, minRate, maxRate)
+        self.endpoints = {}
+        for path, settings in (endpoints or {}).items():
+            self.endpoints[path] = TokenBucket(settings.get("rate", rate), settings.get("burst"),
+                                               settings.get("minRate", minRate), settings.get("maxRate", maxRate))
+
+
+    def bucket(self, endpoint):
+        """
+        :return: the bucket that answers for an endpoint, its own or the shared one
+        """
+        return self.endpoints.get(endpoint, self.shared)
+
+
+    def acquire(self, endpoint):
+        """
+        Block's until a request to endpoint may be sent
+
+        :param endpoint: the request path without the query string
+        """
+        buckets = [self.shared] if endpoint not in self.endpoints else [self.endpoints[endpoint], self.shared]
+        wait = max(bucket.reserve() for bucket in buckets)
+        if wait <= 0:
+            return
+
+        bucket = buckets[0]
+        with bucket.lock:
+            bucket.waiting += 1
+        self.publish(endpoint)
+        try:
+            time.sleep(wait)
+        finally:
+            with bucket.lock:
+                bucket.waiting -= 1
+            self.publish(endpoint)
+
+
+    def feedback(self, endpoint, status, retryAfter=None):
+        """
+        Adapt's the rate of an endpoint's bucket to a response
+
+        :param endpoint: the request path without the query string
+        :param status: the response status
+        :param retryAfter: the response's Retry-After header if any
+        """
+        bucket = self.bucket(endpoint)
+        if status in THROTTLED:
+            if bucket.backoff(self.decrease, parseRetryAfter(retryAfter)):
+                print(f"Bronze: {self.name} throttled by {endpoint} ({status}), "
+                      f"slowing down to {bucket.rate:.1f} requests/s.")
+            self.publish(endpoint)
+        elif bucket.rate < bucket.maxRate:
+            bucket.recover(self.increase)
+            self.publish(endpoint)
+
+
+    def publish(self, endpoint):
+        """
+        Update's the rate and queue depth gauges of an endpoint's bucket
+        """
+        path = endpoint if endpoint in self.endpoints else '*'
+        bucket = self.bucket(endpoint)
+        registry.set("bronze_throttle_rate", round(bucket.rate, 3), throttle=self.name, endpoint=path)
+        registry.set("bronze_throttle_waiting", bucket.waiting, throttle=self.name, endpoint=path)
+
+
+    def stats(self):
+        """
+        :return: a dictionary of endpoint ('*' for the shared bucket) to its current rate and
+            the number of requests waiting on it
+        """
+        buckets = {'*': self.shared, **self.endpoints}
+        return {path: {"rate": bucket.rate, "waiting": bucket.waiting} for path, bucket in buckets.items()}
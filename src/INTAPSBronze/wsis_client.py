@@ -3,21 +3,59 @@
 # Program Author: Rediet Worku aka Aethiops II ben Zahab
 #
 # Date Created: 22nd of Septemeber 2024, Monday
-import http.client
 import json
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+import payment_ledger
+from connection_pool import ConnectionPool
+
+
+RECEIPT_PATH = '/api/erp/subscribermanagment/PostBill'
+SESSION_EXPIRED = (401, 403)    # statuses after which the session is renewed and the request retried
+
+
+class WSISLane:
+    """
+    A posting lane; a connection of its own and the WSIS session used on it
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.sessionID = ""
+        self.sessionStarted = 0.0
+
+
 class WSISClient:
     """
     Connect's with WSIS Server/RESTful API and post's payment bills
     """
-    def __init__(self):
+    def __init__(self, ledger=None, receiptPath=RECEIPT_PATH, workers=1, sessionTTL=1800, outbox=None,
+                 timeout=30):
+        """
+        :param ledger: an opened PaymentLedger used to skip payments already posted, None to post all
+        :param receiptPath: the WSIS API path receipts are posted to
+        :param workers: number of lanes posting receipts in parallel, each with a connection and session
+        :param sessionTTL: seconds after which a lane starts a new WSIS session
+        :param outbox: an opened Outbox journaling every receipt until WSIS answers, None to post without one
+        :param timeout: seconds a socket read or connect may block before the request fails
+        """
         self.sessionID = ""
-        self.conn = None
+        self.pool = None
         self.state = False
         self.paymentCenter = {}         # wsis payment center info
         self.username = ""              # wsis username
+        self.password = ""              # kept to renew sessions
+        self.ledger = ledger
+        self.receiptPath = receiptPath
+        self.workers = max(1, int(workers))
+        self.sessionTTL = sessionTTL
+        self.outbox = outbox
+        self.timeout = timeout
+        self.host = None
+        self.port = None
+        self.lanes = []
 
         self.headers = {
             'content-type':'application/json',
@@ -27,12 +65,16 @@ class WSISClient:
 
     def connect(self, host, port):
         """
-        Start's a TCP connection with WSIS Server
+        Prepare's a keep-alive connection with WSIS Server, the TCP connection is opened on
+        first request and transparently re-opened whenever WSIS or a proxy drops it
 
         :param host: hostname or ip address
         :param port: the port # for WSIS Server
         """
-        self.conn = http.client.HTTPConnection(host, port)
+        self.host = host
+        self.port = port
+        self.pool = ConnectionPool(host, port, 1, secure=False, timeout=self.timeout)
+        self.lanes = [WSISLane(self.pool)]
         self.state = True
 
 
@@ -41,11 +83,27 @@ class WSISClient:
         Tear's down the active connection with WSIS
         """
         if self.state:
-            self.conn.close()
+            for lane in self.lanes:
+                lane.pool.close()
 
         self.state = False
 
 
+    def request(self, method, url, body, lane=None):
+        """
+        Send's a request to WSIS and reads its response
+
+        :param method: the HTTP verb
+        :param url: the WSIS API path
+        :param body: a JSON serializable object to send as request body
+        :param lane: the WSISLane to send on, the client's own connection if None
+        :return: a tuple of response status and response body as string
+        """
+        pool = self.pool if lane is None else lane.pool
+        res, data = pool.request(method, url, body=json.dumps(body), headers=self.headers)
+        return res.status, data.decode('utf-8')
+
+
     def startSession(self, uname, password):
         """
         After successful TCP connection, we need to start application level session with
@@ -58,63 +116,268 @@ class WSISClient:
         if self.state == False:
             return
         
+        self.username = uname
+        self.password = password
+        if self.openSession(self.lanes[0]):
+            self.sessionID = self.lanes[0].sessionID
+            return True
+        
+        return False
+
+
+    def openSession(self, lane):
+        """
+        Start's a new WSIS session on a lane using the credentials given to startSession
+
+        :param lane: the WSISLane to start the session for
+        :return: True on success
+        """
         pars = {
-            "UserName":uname,
-            "Password":password,
+            "UserName":self.username,
+            "Password":self.password,
             "Source":"Bronze"
         }
-        self.conn.request('POST', '/api/app/server/CreateUserSession', headers=self.headers, body=json.dumps(pars))
-        res = self.conn.getresponse()
-        result = json.loads(res.read().decode('utf-8'))
+        status, result = self.request('POST', '/api/app/server/CreateUserSession', pars, lane)
         
-        if res.status == 200:
-            self.sessionID = result
-            self.username = uname
+        if status == 200:
+            lane.sessionID = json.loads(result)
+            lane.sessionStarted = time.monotonic()
             return True
         
+        print(f"Bronze: WSIS session could not be started: {status} {result}")
         return False
+
+
+    def laneSession(self, lane):
+        """
+        :return: the session id of a lane, a new session is started first if the lane has none
+            or its session is older than sessionTTL
+        """
+        if lane.sessionID == "" or time.monotonic() - lane.sessionStarted >= self.sessionTTL:
+            self.openSession(lane)
+        return lane.sessionID
     
 
     def getPaymentCenter(self):
         """
         initalizes paymentCenter member object by using the info from WSIS Server itself, 
         rather than acquiring it from db
+
+        :return: the payment center info
         """
         if self.state == False or self.sessionID == "":
             return
         
         pars = {
-            "sessionID": self.sessionID,
+            "sessionID": self.laneSession(self.lanes[0]),
             "userID": self.username
         }
-        self.conn.request('POST', '/api/erp/subscribermanagment/GetPaymentCenter', headers=self.headers, body=json.dumps(pars))
-        res = self.conn.getresponse()
-        self.paymentCenter = json.dumps(res.read().decode('utf-8'))
+        status, result = self.request('POST', '/api/erp/subscribermanagment/GetPaymentCenter', pars)
+        if status == 200:
+            self.paymentCenter = json.loads(result)
+        return self.paymentCenter
         
 
-    def postBillPayment(self, rawPayments, iqe, instrumentCode, assetID, town):
+    def postBillPayment(self, payments, iqe, instrumentCode, assetID, batchSize=500, onResult=None):
         """
-        For each payments made from INSA Derash, this function post's the payments to WSIS
+        For each payments made from INSA Derash, this function post's the payments to WSIS.
+        Payments are consumed as they stream in and handled batchSize at a time, the settled
+        bills of a batch being resolved with a query per round (see postBatch). Payments the ledger has already
+        posted, that were in flight when Bronze last stopped, that WSIS may have booked or that
+        were rejected and aren't due for a retry are skipped.
         
-        :param payments: A listof payments made through INSA Derash
+        :param payments: An iterable of Payment records made through INSA Derash
         :param iqe: An object of DB interface
         :param instrumentCode: Cash Code or Instrument code (WSIS stuff)
         :param assetID: WSIS asset account ID
-        :param town: the utility town name
+        :param batchSize: number of payments resolved against the database at a time
+        :param onResult: optional callback receiving each Payment posted or rejected, its ledger state
+            (posted, failed or unknown) and the error if any; it may be called from the posting lanes
+        :return: the number of payments posted
         """
-        payments = rawPayments.split('\n')[1:]
-        
+        handled = 0
+        batch = []
         for payment in payments:
-            pay = payment.split(',')
-            if town in pay[3]:
-                pay[3] = pay[3].split('-')[1]
-            bills = iqe.getSettledBills(pay[3].strip('"'))
-
-            if len(pay) < 8:
-                print(pay)
-                continue
-            obj = {
-                "sessionID": self.sessionID,
+            if self.ledger is not None:
+                state = self.ledger.markDownloaded(payment)
+                if state == payment_ledger.POSTED:
+                    continue
+                if state == payment_ledger.POSTING:
+                    print(f"Bronze: payment {payment.confirmationCode} was in flight when Bronze stopped, "
+                          "check WSIS before reposting it.")
+                    continue
+                if state == payment_ledger.UNKNOWN:
+                    print(f"Bronze: payment {payment.confirmationCode} may have been booked by WSIS, "
+                          "check WSIS before reposting it.")
+                    continue
+                if state == payment_ledger.FAILED and not self.ledger.isRetryDue(payment.confirmationCode):
+                    continue
+
+            batch.append(payment)
+            if len(batch) >= batchSize:
+                handled += self.postBatch(batch, iqe, instrumentCode, assetID, onResult)
+                batch = []
+
+        if batch:
+            handled += self.postBatch(batch, iqe, instrumentCode, assetID, onResult)
+        return handled
+
+
+    def postBatch(self, payments, iqe, instrumentCode, assetID, onResult=None):
+        """
+        Post's a batch of payments to WSIS. Payments are sharded by customer over the lanes,
+        lanes post in parallel while the receipts of a customer are posted in order on one lane.
+        A customer's receipt settles all of their unpaid bills, so only one payment per customer
+        is posted a round; the customer's other payments are posted in the next round, against
+        the bills still unpaid once the first is booked.
+
+        :param payments: a list of Payment records
+        :param iqe: An object of DB interface
+        :param instrumentCode: Cash Code or Instrument code (WSIS stuff)
+        :param assetID: WSIS asset account ID
+        :param onResult: optional callback, see postBillPayment
+        :return: the number of payments posted
+        """
+        while len(self.lanes) < self.workers:
+            self.lanes.append(WSISLane(ConnectionPool(self.host, self.port, 1, secure=False, timeout=self.timeout)))
+
+        posted = 0
+        while payments:
+            # resolve the settled bills of the whole round in one go
+            settled = iqe.getSettledBillsBatch(payment.billID for payment in payments)
+
+            # the unpaid bills of a customer are the same whichever bill was paid, so the first one
+            # identifies the customer
+            shards = [[] for _ in range(self.workers)]
+            customers = set()
+            later = []
+            for payment in payments:
+                bills = settled.get(int(payment.billID), []) if payment.billID.isdigit() else []
+                customer = bills[0] if bills else payment.billID
+                if customer in customers:
+                    later.append(payment)
+                    continue
+                customers.add(customer)
+                shards[hash(customer) % self.workers].append((payment, bills))
+
+            post = lambda lane, shard: self.postShard(lane, shard, instrumentCode, assetID, onResult)
+            if self.workers == 1:
+                posted += post(self.lanes[0], shards[0])
+            else:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    posted += sum(executor.map(post, self.lanes, shards))
+            payments = later
+
+        return posted
+
+
+    def postShard(self, lane, shard, instrumentCode, assetID, onResult=None):
+        """
+        Post's the receipts of a shard one after the other on a lane. A receipt rejected for an
+        expired session is posted once more after the lane's session is renewed.
+
+        :param lane: the WSISLane to post on
+        :param shard: a list of (Payment, settled bill ids) tuples
+        :param instrumentCode: Cash Code or Instrument code (WSIS stuff)
+        :param assetID: WSIS asset account ID
+        :param onResult: optional callback, see postBillPayment
+        :return: the number of payments posted
+        """
+        posted = 0
+        for payment, bills in shard:
+            obj = self.buildReceipt(payment, bills, instrumentCode, assetID, self.laneSession(lane))
+
+            if self.ledger is not None:
+                self.ledger.markPosting(payment.confirmationCode)
+            entryID = None
+            if self.outbox is not None:
+                entryID = self.outbox.append('wsis', 'POST', self.receiptPath, obj,
+                                             {"confirmationCode": payment.confirmationCode})
+
+            status = None
+            try:
+                status, result = self.postReceipt(obj, lane)
+                if status in SESSION_EXPIRED and self.openSession(lane):
+                    obj["sessionID"] = lane.sessionID
+                    status, result = self.postReceipt(obj, lane)
+            finally:
+                # a receipt that raised stays in POSTING in the ledger and is reported from there
+                if entryID is not None:
+                    self.outbox.done(entryID, status)
+
+            if status == 200:
+                posted += 1
+                if self.ledger is not None:
+                    self.ledger.markPosted(payment.confirmationCode)
+                if onResult is not None:
+                    onResult(payment, payment_ledger.POSTED, None)
+            elif 400 <= status < 500:
+                print(f"Bronze: WSIS rejected payment {payment.confirmationCode}: {status} {result}")
+                if self.ledger is not None and self.ledger.markFailed(payment.confirmationCode, f"{status} {result}"):
+                    print(f"Bronze: payment {payment.confirmationCode} is out of attempts and no longer retried, "
+                          "check it in WSIS.")
+                if onResult is not None:
+                    onResult(payment, payment_ledger.FAILED, f"{status} {result}")
+            else:
+                # a server error may come after the receipt was booked, sending it again could book it twice
+                print(f"Bronze: WSIS answered payment {payment.confirmationCode} with {status} {result}, "
+                      "check WSIS before reposting it.")
+                if self.ledger is not None:
+                    self.ledger.markUnknown(payment.confirmationCode, f"{status} {result}")
+                if onResult is not None:
+                    onResult(payment, payment_ledger.UNKNOWN, f"{status} {result}")
+
+        return posted
+
+
+    def replayOutbox(self):
+        """
+        Look's at the receipts that were in flight when Bronze last stopped. WSIS may or may not
+        have booked them and a receipt posted twice is a payment booked twice, so they are not
+        sent again; the ones the ledger has no answer for stay in POSTING and are reported for
+        checking in WSIS, the journal entry holds the exact receipt.
+
+        :return: the number of receipts left for checking
+        """
+        if self.outbox is None:
+            return 0
+
+        unconfirmed = 0
+        for entry in self.outbox.pending('wsis'):
+            code = entry["meta"].get("confirmationCode")
+            state = None if self.ledger is None else self.ledger.getState(code)
+            if state not in (payment_ledger.POSTED, payment_ledger.FAILED, payment_ledger.UNKNOWN):
+                unconfirmed += 1
+                print(f"Bronze: receipt for payment {code} was in flight when Bronze stopped, "
+                      "check WSIS before reposting it.")
+            self.outbox.done(entry["id"], state or "unconfirmed")
+        return unconfirmed
+
+
+    def postReceipt(self, receipt, lane=None):
+        """
+        Post's a receipt request built by buildReceipt to WSIS
+
+        :param receipt: the receipt request object
+        :param lane: the WSISLane to post on, the client's own connection if None
+        :return: a tuple of the response status and body
+        """
+        return self.request('POST', self.receiptPath, receipt, lane)
+
+
+    def buildReceipt(self, payment, bills, instrumentCode, assetID, sessionID=None):
+        """
+        Build's the WSIS receipt request settling bills for a Derash payment
+
+        :param payment: the Payment record
+        :param bills: the unpaid bill ids of the customer to settle
+        :param instrumentCode: Cash Code or Instrument code (WSIS stuff)
+        :param assetID: WSIS asset account ID
+        :param sessionID: the WSIS session to post with, the client's own session if None
+        :return: the receipt request object
+        """
+        return {
+                "sessionID": self.sessionID if sessionID is None else sessionID,
                 "receipt": {
                 "receiptNumber":None,
                 "offline":True,
@@ -131,7 +394,7 @@ class WSISClient:
                 "documentReference": None,
                 "documentDate": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
                 "remark":None,
-                "amount": float(pay[4])
+                "amount": payment.amount
                 }],
                 "bankDepositDocuments": [],
                 "customer": None,
@@ -142,22 +405,19 @@ class WSISClient:
                 "AccountDocumetnID": -1,
                 "documentTypeID": -1,
                 "paperRef": "",
-                "shortDescription": f"Settled through Derash. Confirmation code: {pay[-1]}, Agent: {pay[-2]}",
+                "shortDescription": f"Settled through Derash. Confirmation code: {payment.confirmationCode}, Agent: {payment.agent}",
                 "longDescription": None,
                 "reversed": False,
                 "scheduled": False,
                 "materialized": False,
                 "materializedOn": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
                 "totalAmount": -1.0,
-                "totalInstrument": float(pay[-4]),
+                "totalInstrument": payment.amount,
                 "isFutureDate": False,
                 "documentDate": datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
                 "posted": False
                 }
             }
-            print(pay)
-            print(json.dumps(obj))
-            break
 
 
     def dateToTicks(self, date):